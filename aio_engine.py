@@ -0,0 +1,103 @@
+"""
+asyncio engine for the SMTP/POP3 server
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+"""
+import asyncio
+import resource
+import metrics
+
+# registered by smtp_server too; registering again returns the same counter, which both engines count into
+received_bytes = metrics.registry.counter("mail_received_bytes", "Bytes received from clients.", ("protocol",))
+
+class MailProtocol(asyncio.Protocol):
+    """One client connection served by the asyncio engine, standing in for the client socket in ``Server.clients``.
+    """
+    def __init__(self, server, pop):
+        """Constructor for the MailProtocol class.
+
+        :param server: the Server whose state machines handle this connection.
+        :param pop: whether the connection was accepted on the POP3 listener.
+        """
+        self.server = server
+        self.pop = pop
+        self.transport = None
+
+    def connection_made(self, transport):
+        """Register the new connection with the server and greet the client.
+
+        :param transport: the transport of the connection.
+        """
+        self.transport = transport
+        self.server.add_client(self, transport.get_extra_info("peername"), self.pop)
+
+    def data_received(self, data):
+        """Hand received data to the server's state machine.
+
+        :param data: the bytes received from the client.
+        """
+        if self not in self.server.clients:
+            return
+        received_bytes.inc("pop3" if self.pop else "smtp", amount=len(data))
+        self.server.clients[self]["buffer"] += data
+        if self.pop:
+            self.server.pop_commands(self)
+        else:
+            self.server.smtp_commands(self)
+
+    def connection_lost(self, exc):
+        """Forget a connection closed by the client.
+
+        :param exc: the exception that closed the connection, or None on a clean close.
+        """
+        client = self.server.clients.pop(self, None)
+        if client is not None:
+            self.server.drop_message(client)
+
+    def send(self, data):
+        """Queue data to be sent to the client. The transport buffers whatever the socket does not take right away, so
+        this always accepts all of the data.
+
+        :param data: the bytes to send.
+        :return: the number of bytes accepted.
+        """
+        self.transport.write(bytes(data))
+        return len(data)
+
+    def close(self):
+        """Close the connection once queued data has been sent.
+        """
+        self.transport.close()
+
+def raise_fd_limit():
+    """Raise the soft open file limit to the hard limit so that idle connections are bounded by memory rather than
+    the default of 1024 descriptors.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+async def serve(server):
+    """Serve the SMTP and POP3 listeners of a server until cancelled.
+
+    :param server: the Server to serve.
+    """
+    server.loop = asyncio.get_running_loop()
+    smtp = await server.loop.create_server(lambda: MailProtocol(server, False), sock=server.server_sock, backlog=1024)
+    pop = await server.loop.create_server(lambda: MailProtocol(server, True), sock=server.pop_sock, backlog=1024)
+    async with smtp, pop:
+        await asyncio.gather(smtp.serve_forever(), pop.serve_forever())
+
+def run(server):
+    """Run a server on the asyncio engine.
+
+    :param server: the Server to run.
+    """
+    raise_fd_limit()
+    try:
+        asyncio.run(serve(server))
+    finally:
+        server.loop = None
+        server.flush_mailboxes()
@@ -0,0 +1,403 @@
+"""
+End-to-end load generator for the DNS, SMTP and POP3 servers
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+
+Starts a DNS server and one or more mail servers per domain on loopback, each domain with its own temporary data
+directory, then drives them from concurrent client threads with a mix of local SMTP deliveries, deliveries relayed to
+another domain, and POP3 sessions. Prints a JSON report of throughput, per command latency percentiles and memory use,
+so runs on different commits, storage engines or event loops can be compared.
+
+    python3 benchmarks/loadgen.py --engine asyncio --clients 16 --duration 20 --mix smtp=6,relay=2,pop=2 -o run.json
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dns.dns
+import smtp_server
+from linereader import LineReader
+
+PASSWORD_HASH = hashlib.sha256(b"password").hexdigest() # every generated account's password is "password"
+OPERATIONS = ("smtp", "relay", "pop")
+
+class Recorder:
+    """Latencies of every command sent during a run, and counts of the operations made of them.
+    """
+    def __init__(self):
+        """Constructor for the Recorder class.
+        """
+        self.latencies = {} # command -> list of seconds
+        self.operations = {} # operation -> [completed, failed]
+        self.lock = threading.Lock()
+
+    def command(self, name, seconds):
+        """Record how long a command took.
+
+        :param name: the command, e.g. "RETR".
+        :param seconds: the time from sending it to reading its whole response.
+        """
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def operation(self, kind, ok):
+        """Record the outcome of one operation.
+
+        :param kind: the kind of operation, one of OPERATIONS.
+        :param ok: whether every command of it succeeded.
+        """
+        with self.lock:
+            counts = self.operations.setdefault(kind, [0, 0])
+            counts[0 if ok else 1] += 1
+
+class Session:
+    """One client connection whose commands are timed into a Recorder.
+    """
+    def __init__(self, recorder, addr):
+        """Connect to a server and read its greeting.
+
+        :param recorder: the Recorder to time commands into.
+        :param addr: the (ip, port) to connect to.
+        """
+        self.recorder = recorder
+        started = time.perf_counter()
+        self.sock = socket.create_connection(addr, timeout=30)
+        self.reader = LineReader(self.sock)
+        self.reader.read_reply()
+        recorder.command("CONNECT", time.perf_counter() - started)
+
+    def command(self, name, line, expected, multiline = False):
+        """Send a command, wait for its response and time the round trip.
+
+        :param name: the name to record the latency under.
+        :param line: the command to send, without its CRLF.
+        :param expected: the prefix of a successful response.
+        :param multiline: whether a successful response is followed by a dot-terminated block.
+        :return: the response.
+        :raises RuntimeError: if the response does not start with expected.
+        """
+        started = time.perf_counter()
+        self.sock.sendall(line + b"\r\n")
+        response = self.reader.read_reply()
+        if multiline and response.startswith(b"+OK"):
+            response += self.reader.read_block()
+        self.recorder.command(name, time.perf_counter() - started)
+        if not response.startswith(expected):
+            raise RuntimeError(f"{name} failed: {response[:80]!r}")
+        return response
+
+    def close(self):
+        """Close the connection.
+        """
+        self.sock.close()
+
+def free_port():
+    """Find a TCP port that nothing is listening on.
+
+    :return: the port number.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(ordered, p):
+    """Get a percentile of a sorted list by the nearest rank method.
+
+    :param ordered: the sorted values.
+    :param p: the percentile, from 0 to 100.
+    :return: the value.
+    """
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+def parse_mix(text):
+    """Parse an operation mix such as "smtp=6,relay=2,pop=2".
+
+    :param text: the mix.
+    :return: a dict of operation to relative weight.
+    """
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {kind!r}, expected one of {", ".join(OPERATIONS)}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def memory():
+    """Get the memory use of the process, in which every server runs.
+
+    :return: a dict of the current and peak resident set size, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        current = None
+    return {"rss_bytes": current, "peak_rss_bytes": peak}
+
+def git_commit():
+    """Get the commit of the code being measured.
+
+    :return: the commit hash, or None if it cannot be found.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Cluster:
+    """A DNS server and the mail servers of several domains, running on loopback in this process.
+    """
+    def __init__(self, workdir, domains, servers_per_domain, users, engine, seed, message_size):
+        """Create the domains' data directories, then start the DNS server and every mail server.
+
+        :param workdir: the directory to create the data directories in. Servers find them relative to it.
+        :param domains: the number of domains.
+        :param servers_per_domain: the number of servers registered for each domain.
+        :param users: the number of accounts in each domain.
+        :param engine: the event loop the servers run on, "select" or "asyncio".
+        :param seed: the number of messages put in every mailbox before the run.
+        :param message_size: the size of the body of each message, in bytes.
+        """
+        self.domains = [f"bench{i}.test" for i in range(domains)]
+        self.users = [f"user{i}" for i in range(users)]
+        self.endpoints = {} # domain -> list of (smtp addr, pop addr)
+        self.servers = []
+        self.heartbeats = []
+        for domain in self.domains:
+            data_dir = os.path.join(workdir, domain.split(".")[0])
+            os.makedirs(data_dir)
+            with open(os.path.join(data_dir, "accounts.json"), "w") as f:
+                json.dump({**{user: PASSWORD_HASH for user in self.users}, "server": smtp_server.SERVER_PASSWORD}, f)
+        self.dns = dns.dns.DNS(port=dns.dns.DNS_PORT, table_path=os.path.join(workdir, "dns_table.json"))
+        threading.Thread(target=self.dns.run, daemon=True).start()
+        for domain in self.domains:
+            for _ in range(servers_per_domain):
+                smtp_port, pop_port = free_port(), free_port()
+                server = smtp_server.Server(domain=domain, listeners=smtp_server.open_listeners(smtp_port, pop_port))
+                threading.Thread(target=smtp_server.run_server, args=(server, engine), daemon=True).start()
+                self.heartbeats.append(dns.dns.dns_heartbeat("127.0.0.1", dns.dns.DNS_PORT, domain, smtp_port))
+                self.endpoints.setdefault(domain, []).append((("127.0.0.1", smtp_port), ("127.0.0.1", pop_port)))
+                self.servers.append(server)
+            body = make_body(message_size)
+            for user in self.users:
+                for i in range(seed):
+                    self.server(domain).mailboxes.deliver(user, f"seed@{domain}", f"Subject: seed {i}\r\n\r\n{body}.\r\n")
+
+    def server(self, domain):
+        """Get the first server of a domain.
+
+        :param domain: the domain.
+        :return: the Server.
+        """
+        return self.servers[self.domains.index(domain) * (len(self.servers) // len(self.domains))]
+
+    def relay_depth(self):
+        """Get the number of messages still waiting to be relayed.
+
+        :return: the number of messages, across every server.
+        """
+        return sum(server.relay.depth() for server in self.servers)
+
+    def stop(self):
+        """Stop renewing the servers' DNS registrations. The servers themselves run on daemon threads.
+        """
+        for heartbeat in self.heartbeats:
+            heartbeat.set()
+
+def make_body(size):
+    """Build a message body of about the given size, in lines of 72 characters.
+
+    :param size: the size, in bytes.
+    :return: the body, each line ending in CRLF.
+    """
+    line = "x" * 70 + "\r\n"
+    return line * max(1, size // len(line))
+
+def send_mail(recorder, cluster, rng, relay, body):
+    """Deliver one message over SMTP, to an account of the same domain or, with relay, of another domain.
+
+    :param recorder: the Recorder to time commands into.
+    :param cluster: the Cluster to send to.
+    :param rng: the worker's random number generator.
+    :param relay: whether to address the message to another domain.
+    :param body: the body of the message.
+    """
+    domain = rng.choice(cluster.domains)
+    others = [d for d in cluster.domains if d != domain] if relay else [domain]
+    user, rcpt = rng.choice(cluster.users), f"{rng.choice(cluster.users)}@{rng.choice(others)}"
+    session = Session(recorder, rng.choice(cluster.endpoints[domain])[0])
+    try:
+        session.command("EHLO", b"EHLO loadgen", b"250")
+        session.command("AUTH", b"AUTH LOGIN", b"334")
+        session.command("AUTH", base64.b64encode(user.encode()), b"334")
+        session.command("AUTH", base64.b64encode(PASSWORD_HASH.encode()), b"235")
+        session.command("MAIL", f"MAIL FROM:{user}@{domain}".encode(), b"250")
+        session.command("RCPT", f"RCPT TO:{rcpt}".encode(), b"250")
+        session.command("DATA", b"DATA", b"354")
+        session.command("DATA_END", f"Subject: load {rng.random()}\r\n\r\n{body}.".encode(), b"250")
+        session.sock.sendall(b"QUIT\r\n") # the SMTP server closes the connection without a reply
+    finally:
+        session.close()
+
+def read_mail(recorder, cluster, rng, dele):
+    """Run one POP3 session: STAT, LIST, RETR of a random message and, with probability dele, DELE of it.
+
+    :param recorder: the Recorder to time commands into.
+    :param cluster: the Cluster to read from.
+    :param rng: the worker's random number generator.
+    :param dele: the probability of deleting the retrieved message.
+    """
+    domain = rng.choice(cluster.domains)
+    user = rng.choice(cluster.users)
+    session = Session(recorder, rng.choice(cluster.endpoints[domain])[1])
+    try:
+        session.command("USER", f"USER {user}".encode(), b"+OK")
+        session.command("PASS", f"PASS {PASSWORD_HASH}".encode(), b"+OK")
+        count = int(session.command("STAT", b"STAT", b"+OK").split()[1])
+        session.command("LIST", b"LIST", b"+OK", multiline=True)
+        if count:
+            num = rng.randint(1, count)
+            session.command("RETR", f"RETR {num}".encode(), b"+OK", multiline=True)
+            if rng.random() < dele:
+                session.command("DELE", f"DELE {num}".encode(), b"+OK")
+        session.command("QUIT", b"QUIT", b"+OK")
+    finally:
+        session.close()
+
+def run_load(cluster, args):
+    """Drive the cluster from concurrent client threads until the duration or the operation count is reached.
+
+    :param cluster: the Cluster to load.
+    :param args: the parsed command line arguments.
+    :return: the Recorder holding the results, and the seconds the load ran for.
+    """
+    recorder = Recorder()
+    kinds, weights = zip(*args.mix.items())
+    body = make_body(args.message_size)
+    remaining = [args.operations]
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def work(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            with lock:
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            kind = rng.choices(kinds, weights)[0]
+            try:
+                if kind == "pop":
+                    read_mail(recorder, cluster, rng, args.dele)
+                else:
+                    send_mail(recorder, cluster, rng, kind == "relay", body)
+                recorder.operation(kind, True)
+            except (OSError, RuntimeError, ConnectionError):
+                recorder.operation(kind, False)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=work, args=(args.seed + i,), daemon=True) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.monotonic() - started
+
+def report(recorder, seconds, drain_seconds, args):
+    """Summarize a run.
+
+    :param recorder: the Recorder holding the results.
+    :param seconds: how long the load ran for.
+    :param drain_seconds: how long the relay queues took to empty after it, or None if they did not.
+    :param args: the parsed command line arguments.
+    :return: the report, as a dict ready to be written as JSON.
+    """
+    commands = {}
+    for name, values in sorted(recorder.latencies.items()):
+        ordered = sorted(values)
+        commands[name] = {"count": len(ordered), "mean_ms": sum(ordered) / len(ordered) * 1000,
+                          **{f"p{p}_ms": percentile(ordered, p) * 1000 for p in (50, 95, 99)},
+                          "max_ms": ordered[-1] * 1000}
+    operations = {kind: {"completed": ok, "failed": failed, "per_second": ok / seconds}
+                  for kind, (ok, failed) in sorted(recorder.operations.items())}
+    completed = sum(op["completed"] for op in operations.values())
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "keep")},
+        "seconds": seconds,
+        "throughput": {"operations_per_second": completed / seconds, "commands_per_second": sum(c["count"] for c in commands.values()) / seconds},
+        "operations": operations,
+        "commands": commands,
+        "relay_drain_seconds": drain_seconds,
+        "memory": memory(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the DNS, SMTP and POP3 servers on loopback and report throughput, latency and memory use as JSON.")
+    parser.add_argument("--engine", choices=["select", "asyncio"], default="select", help="Event loop the mail servers run on (default: select)")
+    parser.add_argument("--domains", type=int, default=2, help="Number of mail domains (default: 2)")
+    parser.add_argument("--servers-per-domain", type=int, default=1, help="Number of servers registered for each domain (default: 1)")
+    parser.add_argument("--users", type=int, default=20, help="Number of accounts in each domain (default: 20)")
+    parser.add_argument("--seed-messages", dest="seed_messages", type=int, default=20, help="Messages put in every mailbox before the run (default: 20)")
+    parser.add_argument("--message-size", type=int, default=2048, help="Size of each message body, in bytes (default: 2048)")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent client threads (default: 8)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run the load for (default: 10)")
+    parser.add_argument("--operations", type=int, default=None, help="Stop after this many operations, if before the duration is up")
+    parser.add_argument("--mix", type=parse_mix, default="smtp=6,relay=2,pop=2", help="Relative weights of the operations: smtp (local delivery), relay (delivery to another domain) and pop (a STAT, LIST, RETR, DELE session) (default: smtp=6,relay=2,pop=2)")
+    parser.add_argument("--dele", type=float, default=0.5, help="Probability that a POP3 session deletes the message it retrieved (default: 0.5)")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="Seconds to wait for the relay queues to empty after the load (default: 30)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the client threads' random choices (default: 0)")
+    parser.add_argument("--output", "-o", type=str, default=None, help="File to write the JSON report to (default: standard output)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary data directories after the run")
+    args = parser.parse_args()
+    if args.domains < 2 and "relay" in args.mix:
+        parser.error("relayed deliveries need at least two domains")
+
+    workdir = tempfile.mkdtemp(prefix="smtpop-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir) # servers keep their data relative to the working directory
+    try:
+        cluster = Cluster(workdir, args.domains, args.servers_per_domain, args.users, args.engine, args.seed_messages, args.message_size)
+        time.sleep(0.5) # let the registrations reach the DNS server
+        recorder, seconds = run_load(cluster, args)
+        started = time.monotonic()
+        while cluster.relay_depth() and time.monotonic() - started < args.drain_timeout:
+            time.sleep(0.05)
+        drain_seconds = None if cluster.relay_depth() else time.monotonic() - started
+        cluster.stop()
+        result = report(recorder, seconds, drain_seconds, args)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Data directories kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Microbenchmark of the SMTP and POP3 command parsers
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+
+Times parsing a realistic mix of command lines with the parser the server used before (each line decoded, compared
+against every command with startswith into a list of names, then indexed again and re-sliced for its arguments) and
+with smtp_server.parse_lines, and prints lines per second for each.
+
+    python3 benchmarks/parse_bench.py --lines 200000 --repeat 5
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import smtp_server
+
+# one SMTP session's worth of command lines, and one POP3 session's
+SMTP_SESSION = [b"EHLO bench.test", b"AUTH LOGIN", base64.b64encode(b"landon"), base64.b64encode(b"5e884898da28"),
+                b"MAIL FROM:<bob@bench.test> SIZE=2048", b"RCPT TO:<landon@bench.test>", b"DATA", b"RSET", b"QUIT"]
+POP3_SESSION = [b"USER landon", b"PASS 5e884898da28", b"STAT", b"LIST", b"UIDL", b"TOP 1 0", b"TOP 2 0", b"RETR 1",
+                b"LIST 2", b"UIDL 2", b"DELE 1", b"NOOP", b"RSET", b"QUIT"]
+
+# the legacy parsers: (name, prefix) checked in order, everything else is the fallback
+LEGACY_SMTP = [("EHLO", "EHLO"), ("EHLO", "HELO"), ("AUTH LOGIN", "AUTH LOGIN"), ("MAIL FROM", "MAIL FROM"),
+               ("RCPT TO", "RCPT TO"), ("DATA", "DATA"), ("RSET", "RSET"), ("QUIT", "QUIT")]
+LEGACY_POP3 = [(verb, verb) for verb in ("USER", "PASS", "QUIT", "STAT", "LIST", "RETR", "DELE", "LAST", "RSET", "TOP", "UIDL")]
+
+def legacy(lines, prefixes, unknown):
+    """Parse lines the way the server did before parse_lines, including getting each command's arguments back out
+    of its line, which the handlers did by indexing the line list again and slicing the decoded string.
+
+    :param lines: the command lines.
+    :param prefixes: LEGACY_SMTP or LEGACY_POP3.
+    :param unknown: the name of lines matching no prefix.
+    :return: a list of (command, args) tuples.
+    """
+    commands = []
+    for line in lines:
+        line = line.decode()
+        for name, prefix in prefixes:
+            if line.startswith(prefix):
+                commands.append(name)
+                break
+        else:
+            commands.append(unknown)
+    parsed = []
+    for i, command in enumerate(commands):
+        line = lines[i].decode()
+        parsed.append((command, line[len(command) + 1:] if command != unknown else line))
+    return parsed
+
+def current(lines, verbs, unknown):
+    """Parse lines with smtp_server.parse_lines, consuming every tuple it yields.
+
+    :param lines: the command lines.
+    :param verbs: smtp_server.SMTP_VERBS or smtp_server.POP3_VERBS.
+    :param unknown: the name of lines whose verb is not in the table.
+    :return: a list of (command, args) tuples.
+    """
+    return list(smtp_server.parse_lines(lines, verbs, unknown))
+
+def rate(parse, lines, table, unknown, repeat):
+    """Time a parser over the lines, keeping the best of several runs.
+
+    :return: lines per second.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(lines, table, unknown)
+        best = min(best, time.perf_counter() - started)
+    return len(lines) / best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the legacy and current command parsers.")
+    parser.add_argument('-lines', '--lines', required=False, type=int, default=200000, help='Number of command lines to parse per protocol.')
+    parser.add_argument('-repeat', '--repeat', required=False, type=int, default=5, help='Runs per parser; the best is reported.')
+    args = parser.parse_args()
+
+    print(f"{'protocol':<8} {'legacy lines/s':>16} {'current lines/s':>16} {'speedup':>8}")
+    for protocol, session, prefixes, verbs, unknown in (("smtp", SMTP_SESSION, LEGACY_SMTP, smtp_server.SMTP_VERBS, "TEXT"),
+                                                        ("pop3", POP3_SESSION, LEGACY_POP3, smtp_server.POP3_VERBS, "NOOP")):
+        lines = (session * (args.lines // len(session) + 1))[:args.lines]
+        before = rate(legacy, lines, prefixes, unknown, args.repeat)
+        after = rate(current, lines, verbs, unknown, args.repeat)
+        print(f"{protocol:<8} {before:>16,.0f} {after:>16,.0f} {after / before:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,30 @@ Basic 'DNS' server for our SMTP implementation
 Author: Caleb Naeger - cmn4315@rit.edu and Landon Spitzer - lbs9440@rit.edu
 """
 
+import argparse
 import json
+import logging
+import math
+import os
+import selectors
 import socket
+import threading
+import time
+
+DEFAULT_TTL = 60 # seconds a lookup is cached for when the DNS server does not say
+NEGATIVE_TTL = 5 # seconds an unknown domain is remembered as unknown
+DNS_PORT = 8080
+UDP_TIMEOUT = 0.5 # seconds to wait for a datagram reply before asking again
+UDP_ATTEMPTS = 2 # datagram queries sent before falling back to TCP
+MAX_DATAGRAM = 65507
+SNAPSHOT_INTERVAL = 1.0 # seconds over which updates are coalesced into one snapshot of the table
+LEASE = 30 # seconds a server's registration lasts unless it is renewed
+PRUNE_INTERVAL = 5 # seconds between sweeps for expired registrations
+FAILURE_MEMORY = 60 # seconds a failed connection to a server keeps it at the back of the list
+MAX_WEIGHT = 100 # largest weight a server may register with; each unit is a slot in the round-robin
+REPLY_TIMEOUT = 1 # seconds a TCP client has to take its reply before its connection is dropped
+
+log = logging.getLogger("smtpop.dns") # configured by logconfig; this module also runs from its own directory
 
 def get_local_ip():
     """Returns the LAN IP address of the local machine.
@@ -21,55 +43,344 @@ def get_local_ip():
         s.close()
     return ip
 
-def dns_lookup(dns_ip, dns_port, domain):
-    """Returns the IP address and port of the server associated with the given domain name.
-    
+class ResolverCache:
+    """In-process cache of DNS lookups.
+
+    Answers are kept for the TTL the DNS server sends with them, and domains it cannot resolve are remembered for
+    NEGATIVE_TTL seconds. When several threads look up the same uncached domain at once, only one of them queries the
+    DNS server and the others wait for its answer. Failed connections to the DNS server are not cached.
+
+    A domain may have several servers. resolve lists them starting at a different one on each call, with the servers
+    that recently could not be reached moved to the back in least-recently-failed order.
+    """
+    def __init__(self):
+        """Constructor for the ResolverCache class."""
+        self.entries = {} # (dns_ip, dns_port, domain) -> (list of (ip, port) or None, expiry time)
+        self.inflight = {} # (dns_ip, dns_port, domain) -> Event set once the lookup in progress has finished
+        self.failures = {} # (domain, (ip, port)) -> time of the last failed connection
+        self.turns = {} # domain -> number of times it has been resolved
+        self.lock = threading.Lock()
+
+    def lookup(self, dns_ip, dns_port, domain):
+        """Look up a domain, querying the DNS server only if there is no unexpired answer cached.
+
+        :param dns_ip: The IP address of the DNS server.
+        :param dns_port: The port of the DNS server.
+        :param domain: The domain name of the server.
+        :return: the (ip, port) of each server for the domain in the order the DNS server gave, or None if it could
+            not be resolved.
+        """
+        return self.lookup_many(dns_ip, dns_port, [domain])[domain]
+
+    def resolve(self, dns_ip, dns_port, domain):
+        """Look up a domain and order its servers for the next connection attempt.
+
+        :param dns_ip: The IP address of the DNS server.
+        :param dns_port: The port of the DNS server.
+        :param domain: The domain name of the server.
+        :return: the (ip, port) of each server for the domain, to be tried in order. Empty if it could not be resolved.
+        """
+        endpoints = self.lookup(dns_ip, dns_port, domain) or []
+        with self.lock:
+            turn = self.turns.get(domain, 0)
+            self.turns[domain] = turn + 1
+            cutoff = time.monotonic() - FAILURE_MEMORY
+            failed = {addr: self.failures.get((domain, addr), 0) for addr in endpoints}
+            for addr, when in failed.items():
+                if when and when < cutoff:
+                    del self.failures[(domain, addr)]
+                    failed[addr] = 0
+        if endpoints:
+            turn %= len(endpoints)
+            endpoints = endpoints[turn:] + endpoints[:turn] # spread the connections of this process over the servers
+        return sorted(endpoints, key=failed.get) # stable, so servers that have not failed keep their turn order
+
+    def report_failure(self, domain, addr):
+        """Record that a server of a domain could not be reached, so that it is tried last for a while.
+
+        :param domain: The domain name.
+        :param addr: The (ip, port) of the server.
+        """
+        with self.lock:
+            self.failures[(domain, addr)] = time.monotonic()
+
+    def lookup_many(self, dns_ip, dns_port, domains):
+        """Look up several domains, querying the DNS server once for all of those without an unexpired cached answer.
+
+        :param dns_ip: The IP address of the DNS server.
+        :param dns_port: The port of the DNS server.
+        :param domains: The domain names to look up.
+        :return: a dict from each domain to a list of the (ip, port) of each of its servers, in the order the DNS server
+            gave, or None if it could not be resolved.
+        """
+        answers = {}
+        while True:
+            claimed, waiting = [], []
+            with self.lock:
+                for domain in domains:
+                    if domain in answers:
+                        continue
+                    key = (dns_ip, dns_port, domain)
+                    cached = self.entries.get(key)
+                    if cached is not None and cached[1] > time.monotonic():
+                        answers[domain] = cached[0]
+                    elif key in self.inflight:
+                        waiting.append(self.inflight[key])
+                    else:
+                        self.inflight[key] = threading.Event()
+                        claimed.append(domain)
+            if claimed:
+                results = {}
+                try:
+                    results = dns_query_many(dns_ip, dns_port, claimed)
+                finally:
+                    with self.lock:
+                        for domain in claimed:
+                            answer, ttl = results.get(domain, (None, None))
+                            if ttl is not None:
+                                self.entries[(dns_ip, dns_port, domain)] = (answer, time.monotonic() + ttl)
+                            self.inflight.pop((dns_ip, dns_port, domain)).set()
+                for domain in claimed:
+                    answers[domain] = results.get(domain, (None, None))[0]
+            if not waiting:
+                return answers
+            for pending in waiting:
+                pending.wait() # another thread is asking the DNS server; use its answer
+
+    def invalidate(self, domain):
+        """Forget the cached answers for a domain, so that the next lookup asks the DNS server again.
+
+        :param domain: The domain name to forget.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[2] == domain]:
+                del self.entries[key]
+
+resolver = ResolverCache()
+
+def dns_request(dns_ip, dns_port, request):
+    """Sends one request to the DNS server and returns its reply. The request is sent as a UDP datagram first, and
+    over TCP if no datagram reply arrives or the reply is too large for one.
+
     :param dns_ip: The IP address of the DNS server.
     :param dns_port: The port of the DNS server.
-    :param domain: The domain name of the server.
-    :return ret: The IP address and port of the server associated with the given domain name. 
+    :param request: The request to send.
+    :return: The reply of the DNS server, or None if it could not be reached.
     """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(UDP_TIMEOUT)
+    try:
+        s.connect((dns_ip, dns_port))
+        for _ in range(UDP_ATTEMPTS):
+            s.send(request.encode())
+            try:
+                ret = s.recv(MAX_DATAGRAM).decode()
+            except TimeoutError:
+                continue
+            if ret != "TRUNCATED":
+                return ret
+            break
+    except OSError:
+        pass # nothing is listening for datagrams; ask over TCP
+    finally:
+        s.close()
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((dns_ip, dns_port))
-        s.sendall(f"REQ {domain}".encode())
-        ret = s.recv(1024).decode()
-        if not ret.startswith("ERROR"):
-            s.close()
-            return ret
-        else:
-            s.close()
-            print(f"DNS Couldn't resolve hostname {domain}")
-            return None
+        s.sendall(request.encode())
+        ret = b""
+        while data := s.recv(4096): # the DNS server closes the connection after its reply
+            ret += data
+        s.close()
+        return ret.decode()
     except Exception as e:
-        print(f"Connection failed: {e}")
+        log.warning("Could not reach the DNS server at %s:%s: %s", dns_ip, dns_port, e)
         return None
 
-def dns_update(dns_ip, dns_port, domain, my_port):
+def dns_query_many(dns_ip, dns_port, domains):
+    """Asks the DNS server for the IP address and port of the servers associated with several domain names at once,
+    bypassing the cache.
+
+    :param dns_ip: The IP address of the DNS server.
+    :param dns_port: The port of the DNS server.
+    :param domains: The domain names of the servers.
+    :return: A dict from each domain to the (ip, port) of each of its servers, or None, and how many seconds that
+        answer may be cached for. Empty if the DNS server could not be reached.
+    """
+    ret = dns_request(dns_ip, dns_port, f"REQ {" ".join(domains)}")
+    if ret is None:
+        return {}
+    # a single domain is answered with a bare "ip port ttl" line, several with one "domain ip port ttl" line each
+    lines = [f"{domains[0]} {ret}"] if len(domains) == 1 else ret.split("\n")
+    results = {}
+    for line in lines:
+        domain, _, answer = line.partition(" ")
+        if answer.startswith("ERROR"):
+            log.info("DNS couldn't resolve hostname %s", domain)
+            results[domain] = (None, NEGATIVE_TTL)
+        elif answer:
+            fields = answer.split(" ")
+            ttl = int(fields[2]) if len(fields) > 2 and fields[2].isdigit() else DEFAULT_TTL
+            endpoints = [(fields[0], int(fields[1]))] + [(ip, int(port)) for ip, port in zip(fields[3::2], fields[4::2])]
+            results[domain] = (endpoints, ttl)
+    return results
+
+def dns_lookup(dns_ip, dns_port, domain):
+    """Returns the IP address and port of the server associated with the given domain name, from the resolver cache
+    when possible.
+    
+    :param dns_ip: The IP address of the DNS server.
+    :param dns_port: The port of the DNS server.
+    :param domain: The domain name of the server.
+    :return ret: The IP address and port of the server associated with the given domain name. 
+    """
+    endpoints = resolver.resolve(dns_ip, dns_port, domain)
+    return f"{endpoints[0][0]} {endpoints[0][1]}" if endpoints else None
+
+def dns_resolve(dns_ip, dns_port, domain):
+    """Returns every server associated with the given domain name, in the order they should be tried: rotated on each
+    call to spread connections over them, with the servers that recently failed last.
+
+    :param dns_ip: The IP address of the DNS server.
+    :param dns_port: The port of the DNS server.
+    :param domain: The domain name of the servers.
+    :return: A list of the (ip, port) of each server, empty if the domain could not be resolved.
+    """
+    return resolver.resolve(dns_ip, dns_port, domain)
+
+def dns_report_failure(domain, addr):
+    """Records that a connection to one of a domain's servers failed, so that dns_resolve lists it last for a while.
+
+    :param domain: The domain name of the server.
+    :param addr: The (ip, port) of the server.
+    """
+    resolver.report_failure(domain, addr)
+
+def dns_lookup_many(dns_ip, dns_port, domains):
+    """Returns the IP addresses and ports of the servers associated with several domain names, in one round trip to
+    the DNS server for all of those not in the resolver cache.
+
+    :param dns_ip: The IP address of the DNS server.
+    :param dns_port: The port of the DNS server.
+    :param domains: The domain names of the servers.
+    :return: A dict from each domain to the (ip, port) of each of its servers, or None if it could not be resolved.
+    """
+    return resolver.lookup_many(dns_ip, dns_port, list(domains))
+
+def dns_invalidate(domain):
+    """Drops any cached lookup of the given domain name. Called when a connection to the address it resolved to
+    fails, since the server may have moved.
+
+    :param domain: The domain name of the server.
+    """
+    resolver.invalidate(domain)
+
+def dns_update(dns_ip, dns_port, domain, my_port, lease = None, weight = 1):
     """Updates the DNS server with the IP address and port of the server associated with the given domain name.
     
     :param dns_ip: The IP address of the DNS server.
     :param dns_port: The port of the DNS server.
     :param domain: The domain name of the server.
     :param my_port: The port of the server.
+    :param lease: How many seconds the registration lasts, alongside the domain's other servers. 0 withdraws it. When
+        omitted the server replaces any others registered for the domain, permanently.
+    :param weight: How many times as often as a weight 1 server this one is listed first.
     """
+    request = f"UPDATE {domain} {get_local_ip()} {my_port}"
+    if lease is not None:
+        request += f" {lease} {weight}"
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((dns_ip, dns_port))
-        s.sendall(f"UPDATE {domain} {get_local_ip()} {my_port}".encode())
+        s.sendall(request.encode())
         s.close()
+        resolver.invalidate(domain)
     except Exception as e:
-        print(f"Connection failed: {e}")
+        log.warning("Could not reach the DNS server at %s:%s: %s", dns_ip, dns_port, e)
+
+def dns_heartbeat(dns_ip, dns_port, domain, my_port, lease = LEASE, weight = 1):
+    """Registers a server with the DNS and keeps renewing its lease from a background thread until stopped.
+
+    :param dns_ip: The IP address of the DNS server.
+    :param dns_port: The port of the DNS server.
+    :param domain: The domain name of the server.
+    :param my_port: The port of the server.
+    :param lease: How many seconds each registration lasts. It is renewed three times per lease.
+    :param weight: The weight of the server among the domain's servers.
+    :return: An Event which, once set, stops the heartbeat. The registration then lapses when its lease runs out,
+        unless it is withdrawn with a lease of 0.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.is_set():
+            dns_update(dns_ip, dns_port, domain, my_port, lease, weight)
+            stop.wait(lease / 3)
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
 
 class DNS:
-    """DNS server for our SMTP implementation."""
-    def __init__(self) -> None:
-        """Initializes the DNS server."""
-        with open("dns_table.json", "r") as f:
-            self.table = json.load(f)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind(("0.0.0.0", 8080))
+    """DNS server for our SMTP implementation.
+
+    Clients are multiplexed with a selector, so a slow client cannot hold up the others. Lookups are accepted over
+    TCP, and also as UDP datagrams answered with a single datagram; updates are only accepted over TCP. A request
+    names one domain ("REQ a.com", answered "ip port ttl") or several ("REQ a.com b.com", answered with one
+    "domain ip port ttl" line per domain), and either form answers an unknown domain with "ERROR ...".
+
+    A domain can be served by several servers. Each registers with "UPDATE domain ip port lease [weight]" and renews
+    the registration before its lease runs out; registrations that are not renewed are pruned, and a lease of 0
+    withdraws one. Every server of a domain is listed in the answer, as "ip port ttl" followed by " ip port" for each
+    further server, in weighted round-robin order so that successive lookups start at different servers. An UPDATE
+    without a lease replaces all of the domain's servers with one permanent entry, and a leased one drops it. An
+    update whose port, lease or weight cannot be parsed is answered with "ERROR ..." and changes nothing.
+
+    Updates take effect in memory immediately. The table is saved by a background thread, at most once every
+    ``snapshot_interval`` seconds however many updates arrive, by writing a temporary file and renaming it over the
+    table. With ``journal`` set, each update is also appended to a journal that is replayed over the table on
+    startup, so updates made after the last snapshot survive a crash; the journal is trimmed after every snapshot.
+
+    The saved table is loaded in the background while the server starts answering. Lookups that cannot be answered
+    until it has loaded are held back and answered once it has.
+    """
+    def __init__(self, ttl = DEFAULT_TTL, port = DNS_PORT, table_path = "dns_table.json", journal = False, snapshot_interval = SNAPSHOT_INTERVAL) -> None:
+        """Initializes the DNS server.
 
+        :param ttl: The number of seconds clients may cache an answer for.
+        :param port: The port to serve on, over both TCP and UDP.
+        :param table_path: The file the table is saved to.
+        :param journal: Whether to also journal each update as it is applied.
+        :param snapshot_interval: The minimum number of seconds between two snapshots of the table.
+        """
+        self.ttl = ttl
+        self.table = {}
+        self.table_path = table_path
+        self.journal_path = f"{table_path}.journal" if journal else None
+        self.journal = open(self.journal_path, "ab") if journal else None
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock() # guards the table and the journal
+        self.snapshot_lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.changed = threading.Event()
+        self.deferred = [] # (request, client socket or datagram address) waiting for the table to load
+        self.replies = {} # client socket -> [unsent reply bytes, deadline]
+        self.turns = {} # domain -> number of lookups answered, which picks the server listed first
+        self.next_prune = time.time() + PRUNE_INTERVAL
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("0.0.0.0", port))
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind(("0.0.0.0", port))
+        self.udp_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self.udp_socket, selectors.EVENT_READ)
+        self.waker, self.wake_sock = socket.socketpair() # lets the loading thread wake the selector
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        threading.Thread(target=self.load, daemon=True).start()
+        threading.Thread(target=self.persist, daemon=True).start()
 
     def run(self):
         """Runs the DNS server.
@@ -78,30 +389,310 @@ class DNS:
         """
         try:
             while(True):
-                self.socket.listen()
-                client, addr = self.socket.accept()
-                data = client.recv(1024)
-                data = data.decode().split(" ")
-
-                if data[0].startswith("REQ"):
-                    if data[1] in self.table:
-                        client.sendall(f"{self.table[data[1]][0]} {self.table[data[1]][1]}".encode())
-                    else: 
-                        client.sendall("ERROR Could not resolve hostname".encode())
-                elif data[0].startswith("UPDATE"):
-                    self.table[data[1]] = (data[2], int(data[3]))
-                    with open("dns_table.json", "w") as f:
-                        json.dump(self.table, f, indent=4, ensure_ascii=False)
-
-                client.close()
-                print("Client closed")
-        except Exception as e:
-            self.socket.close()
-            raise e
-
-def main():
-    dns = DNS()
+                for key, events in self.selector.select(REPLY_TIMEOUT if self.replies else PRUNE_INTERVAL):
+                    if events & selectors.EVENT_WRITE:
+                        self.write_client(key.fileobj)
+                    elif key.fileobj is self.socket:
+                        self.accept()
+                    elif key.fileobj is self.udp_socket:
+                        self.read_datagram()
+                    elif key.fileobj is self.waker:
+                        self.waker.recv(64)
+                        self.answer_deferred()
+                    else:
+                        self.read_client(key.fileobj)
+                if self.replies:
+                    self.expire_replies()
+                if time.time() >= self.next_prune:
+                    self.prune()
+        finally:
+            if self.loaded.is_set() and self.changed.is_set():
+                self.snapshot() # don't lose the updates of the last interval
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+            self.wake_sock.close()
+
+    def accept(self):
+        """Accepts a new TCP client."""
+        try:
+            client, addr = self.socket.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(False)
+        self.selector.register(client, selectors.EVENT_READ)
+
+    def read_client(self, client):
+        """Answers the request of a TCP client and closes its connection.
+
+        :param client: The client socket, which has data ready to read.
+        """
+        try:
+            data = client.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        self.selector.unregister(client)
+        if data and self.must_wait(data.decode(errors="replace")):
+            self.deferred.append((data.decode(errors="replace"), client))
+            return
+        self.reply_client(client, self.handle(data.decode(errors="replace"), False) if data else None)
+
+    def reply_client(self, client, reply):
+        """Sends the reply to a TCP client's request and closes its connection once the reply is written.
+
+        :param client: The client socket.
+        :param reply: The reply to send, or None if there is none.
+        """
+        if not reply:
+            client.close()
+            log.debug("Client closed")
+            return
+        self.replies[client] = [bytearray(reply.encode()), time.monotonic() + REPLY_TIMEOUT]
+        self.write_client(client)
+        if client in self.replies:
+            self.selector.register(client, selectors.EVENT_WRITE)
+
+    def write_client(self, client):
+        """Writes as much of a client's reply as its socket will take without blocking, and closes the connection once
+        all of it is written.
+
+        :param client: The client socket.
+        """
+        out = self.replies[client][0]
+        try:
+            while out:
+                sent = client.send(out)
+                if sent == 0:
+                    break
+                del out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            out.clear()
+        if not out:
+            self.close_client(client)
+
+    def close_client(self, client):
+        """Closes a TCP client's connection and forgets its reply.
+
+        :param client: The client socket.
+        """
+        self.replies.pop(client, None)
+        if client in self.selector.get_map():
+            self.selector.unregister(client)
+        client.close()
+        log.debug("Client closed")
+
+    def expire_replies(self):
+        """Drops the connections of clients that did not take their replies in time."""
+        now = time.monotonic()
+        for client, (_, deadline) in list(self.replies.items()):
+            if deadline <= now:
+                log.warning("Dropped a client that did not read its reply")
+                self.close_client(client)
+
+    def read_datagram(self):
+        """Answers a lookup sent as a UDP datagram."""
+        try:
+            data, addr = self.udp_socket.recvfrom(MAX_DATAGRAM)
+        except OSError:
+            return
+        if self.must_wait(data.decode(errors="replace")):
+            self.deferred.append((data.decode(errors="replace"), addr))
+            return
+        self.reply_datagram(addr, self.handle(data.decode(errors="replace"), True))
+
+    def reply_datagram(self, addr, reply):
+        """Sends the reply to a datagram request.
+
+        :param addr: The address the request came from.
+        :param reply: The reply to send, or None if there is none.
+        """
+        if reply:
+            reply = reply.encode()
+            try:
+                self.udp_socket.sendto(reply if len(reply) <= MAX_DATAGRAM else b"TRUNCATED", addr)
+            except OSError:
+                pass
+
+    def handle(self, request, udp):
+        """Carries out a single request.
+
+        :param request: The request received from a client.
+        :param udp: Whether the request arrived as a datagram.
+        :return: The reply to send, or None if there is none.
+        """
+        data = request.split()
+        if not data:
+            return None
+        if data[0].startswith("REQ"):
+            if len(data) == 2:
+                return self.resolve(data[1])
+            return "\n".join(f"{domain} {self.resolve(domain)}" for domain in data[1:])
+        elif data[0].startswith("UPDATE") and not udp and len(data) >= 4:
+            try:
+                domain, ip, port = data[1], data[2], int(data[3])
+                lease = float(data[4]) if len(data) > 4 else None
+                weight = int(data[5]) if len(data) > 5 else 1
+            except ValueError:
+                log.warning("Malformed update: %r", request)
+                return "ERROR Malformed update"
+            if not 0 < port < 65536 or not 1 <= weight <= MAX_WEIGHT or (lease is not None and not math.isfinite(lease)):
+                log.warning("Malformed update: %r", request)
+                return "ERROR Malformed update"
+            if lease is None:
+                self.set_endpoints(domain, [[ip, port, None, 1]])
+                return None
+            # a leased registration also replaces any permanent one, which would otherwise never expire
+            endpoints = [e for e in self.table.get(domain, []) if (e[0], e[1]) != (ip, port) and e[2] is not None]
+            if lease > 0:
+                endpoints.append([ip, port, time.time() + lease, weight])
+            self.set_endpoints(domain, endpoints)
+        return None
+
+    def set_endpoints(self, domain, endpoints):
+        """Replaces the servers registered for a domain, journaling the change.
+
+        :param domain: The domain name.
+        :param endpoints: The new list of [ip, port, lease expiry or None, weight] entries. Empty removes the domain.
+        """
+        with self.lock:
+            if endpoints:
+                self.table[domain] = endpoints
+            else:
+                self.table.pop(domain, None)
+            if self.journal is not None:
+                self.journal.write((json.dumps([domain, endpoints]) + "\n").encode())
+                self.journal.flush()
+        self.changed.set() # the snapshot itself is written later, by the persist thread
+
+    def prune(self):
+        """Removes the registrations whose leases have run out."""
+        now = time.time()
+        self.next_prune = now + PRUNE_INTERVAL
+        for domain, endpoints in list(self.table.items()):
+            live = [e for e in endpoints if e[2] is None or e[2] > now]
+            if len(live) != len(endpoints):
+                log.info("Lease expired for %d server(s) of %s", len(endpoints) - len(live), domain)
+                self.set_endpoints(domain, live)
+
+    def must_wait(self, request):
+        """Checks whether a request has to wait for the saved table to load before it can be answered.
+
+        :param request: The request received from a client.
+        :return: True if the request looks up a domain that may only be in the saved table.
+        """
+        data = request.split()
+        return (not self.loaded.is_set() and len(data) > 1 and data[0].startswith("REQ")
+                and any(domain not in self.table for domain in data[1:]))
+
+    def answer_deferred(self):
+        """Answers the requests held back while the saved table was loading."""
+        deferred, self.deferred = self.deferred, []
+        for request, client in deferred:
+            if isinstance(client, socket.socket):
+                self.reply_client(client, self.handle(request, False))
+            else:
+                self.reply_datagram(client, self.handle(request, True))
+
+    def load(self):
+        """Loads the saved table and replays the journal over it. Runs on a background thread; domains updated since
+        the server started keep their new addresses.
+        """
+        table = {}
+        try:
+            with open(self.table_path, "r") as f:
+                for domain, endpoints in json.load(f).items():
+                    if isinstance(endpoints[0], str): # a table saved as a single [ip, port] per domain
+                        endpoints = [[endpoints[0], endpoints[1], None, 1]]
+                    table[domain] = endpoints
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        if self.journal_path is not None:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        domain, endpoints = json.loads(line)
+                    except ValueError:
+                        continue # a torn last line
+                    table[domain] = endpoints
+                    self.changed.set() # fold the replayed updates into the next snapshot
+        with self.lock:
+            for domain, endpoints in table.items():
+                if endpoints:
+                    self.table.setdefault(domain, endpoints)
+        self.loaded.set()
+        self.wake_sock.send(b"\0")
+
+    def persist(self):
+        """Saves the table whenever it has changed, at most once per snapshot interval. Runs on a background thread.
+        """
+        self.loaded.wait() # a snapshot before then would drop the saved domains
+        while True:
+            self.changed.wait()
+            time.sleep(self.snapshot_interval) # let the updates of the interval accumulate
+            self.changed.clear()
+            try:
+                self.snapshot()
+            except OSError as e:
+                log.error("Could not save the DNS table: %s", e)
+                self.changed.set()
+
+    def snapshot(self):
+        """Atomically writes the table to disk, then drops the journaled updates it now contains."""
+        with self.snapshot_lock:
+            with self.lock:
+                table = dict(self.table)
+                mark = self.journal.tell() if self.journal is not None else 0
+            tmp = f"{self.table_path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(table, f, indent=4, ensure_ascii=False)
+            os.replace(tmp, self.table_path)
+            if self.journal is None:
+                return
+            with self.lock:
+                with open(self.journal_path, "rb") as f:
+                    f.seek(mark)
+                    rest = f.read() # updates journaled while the snapshot was being written
+                with open(tmp, "wb") as f:
+                    f.write(rest)
+                os.replace(tmp, self.journal_path)
+                self.journal.close()
+                self.journal = open(self.journal_path, "ab")
+
+    def resolve(self, domain):
+        """Answers a lookup of one domain.
+
+        :param domain: The domain name to look up.
+        :return: "ip port ttl" of the first server for the domain followed by " ip port" for each other one, or an
+            error.
+        """
+        now = time.time()
+        live = [e for e in self.table.get(domain, []) if e[2] is None or e[2] > now]
+        if not live:
+            return "ERROR Could not resolve hostname"
+        # weighted round-robin: a server with weight w is listed first in w of every sum(weights) answers
+        turns = [e for e in live for _ in range(max(1, e[3]))]
+        turn = self.turns.get(domain, 0) % len(turns)
+        self.turns[domain] = turn + 1
+        first = turns[turn]
+        rest = "".join(f" {e[0]} {e[1]}" for e in live[live.index(first) + 1:] + live[:live.index(first)])
+        return f"{first[0]} {first[1]} {self.ttl}{rest}"
+
+def main(journal = False, snapshot_interval = SNAPSHOT_INTERVAL):
+    dns = DNS(journal=journal, snapshot_interval=snapshot_interval)
     dns.run()
 
 if __name__ == "__main__":
-    main()
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # for logconfig, when run from dns/
+    import logconfig
+    parser = argparse.ArgumentParser(description='DNS server for locating SMTP servers by domain.')
+    parser.add_argument('-journal', '--journal', action='store_true', help='Journal every update so that updates made since the last snapshot of the table survive a crash.')
+    parser.add_argument('-snapshot-interval', '--snapshot-interval', required=False, type=float, default=SNAPSHOT_INTERVAL, help=f'Minimum number of seconds between two saves of the table. Defaults to {SNAPSHOT_INTERVAL}.')
+    logconfig.add_arguments(parser)
+    args = parser.parse_args()
+    logconfig.setup_from(args)
+    main(args.journal, args.snapshot_interval)
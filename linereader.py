@@ -0,0 +1,119 @@
+"""
+Buffered reader for SMTP and POP3 responses
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+"""
+
+CHUNK = 64 * 1024 # the least room made in the buffer before each receive
+
+def unstuff(block):
+    """Undo the dot-stuffing of a dot-terminated block, removing the extra "." the sender added to each line starting
+    with one.
+
+    :param block: the raw block, without its terminating "." line.
+    :return: the block with every line's leading ".." turned back into ".".
+    """
+    block = block.replace(b"\r\n..", b"\r\n.")
+    return block[1:] if block.startswith(b"..") else block
+
+class LineReader:
+    """Reads CRLF-terminated lines and dot-terminated blocks from a socket.
+
+    Data is received straight into one growable bytearray through ``recv_into`` on a memoryview, so no intermediate
+    chunk objects are created or joined. Consumed data is only moved out of the way when the buffer needs room, and
+    every search resumes where the previous one stopped, so reading an n byte response takes O(n) time however the
+    network splits or coalesces it. Bytes received past the end of one response stay buffered for the next, which is
+    what lets pipelined responses be read back one at a time.
+    """
+    def __init__(self, sock, chunk = CHUNK):
+        """Constructor for the LineReader class.
+
+        :param sock: the connected socket to read from.
+        :param chunk: the least amount of room to make in the buffer before each receive.
+        """
+        self.sock = sock
+        self.chunk = chunk
+        self.buf = bytearray(chunk)
+        self.start = 0 # offset of the first unread byte
+        self.end = 0 # offset just past the last received byte
+
+    def buffered(self):
+        """Get the number of received bytes not read yet.
+
+        :return: the number of bytes.
+        """
+        return self.end - self.start
+
+    def fill(self):
+        """Receive more data into the buffer, making room first if needed.
+
+        :raises ConnectionError: if the peer has closed the connection.
+        """
+        if len(self.buf) - self.end < self.chunk:
+            unread = self.end - self.start
+            if self.start >= len(self.buf) // 2 and unread + self.chunk <= len(self.buf):
+                # moving the unread tail to the front copies at most half the buffer, and frees at least as much
+                self.buf[:unread] = memoryview(self.buf)[self.start:self.end]
+                self.start, self.end = 0, unread
+            else:
+                self.buf.extend(bytes(max(len(self.buf), self.chunk)))
+        with memoryview(self.buf) as view:
+            received = self.sock.recv_into(view[self.end:])
+        if not received:
+            raise ConnectionError("connection closed by the server")
+        self.end += received
+
+    def find(self, sep, offset = 0):
+        """Wait until a separator has been received, and find it.
+
+        :param sep: the bytes to look for.
+        :param offset: how far past the first unread byte to start looking.
+        :return: the offset of the separator from the first unread byte.
+        """
+        while (found := self.buf.find(sep, self.start + offset, self.end)) == -1:
+            offset = max(offset, self.end - self.start - len(sep) + 1) # don't rescan what has been searched
+            self.fill()
+        return found - self.start
+
+    def take(self, size):
+        """Read a number of bytes that have already been received.
+
+        :param size: the number of bytes to read.
+        :return: the bytes.
+        """
+        with memoryview(self.buf) as view:
+            data = bytes(view[self.start:self.start + size])
+        self.start += size
+        return data
+
+    def read_line(self):
+        """Read one line.
+
+        :return: the line, without its CRLF.
+        """
+        line = self.take(self.find(b"\r\n"))
+        self.start += 2
+        return line
+
+    def read_reply(self):
+        """Read one reply: a single line, or every line of an SMTP reply continued with "250-" style lines.
+
+        :return: the reply, with a CRLF after each line.
+        """
+        lines = [self.read_line()]
+        while lines[-1][:3].isdigit() and lines[-1][3:4] == b"-":
+            lines.append(self.read_line())
+        return b"".join(line + b"\r\n" for line in lines)
+
+    def read_block(self):
+        """Read a dot-terminated block, such as the body of a POP3 RETR response, and undo its dot-stuffing.
+
+        :return: the lines of the block, each with its CRLF, without the terminating "." line.
+        """
+        while self.buffered() < 3:
+            self.fill()
+        if self.buf[self.start:self.start + 3] == b".\r\n": # an empty block
+            self.start += 3
+            return b""
+        block = self.take(self.find(b"\r\n.\r\n") + 2)
+        self.start += 3
+        return unstuff(block)
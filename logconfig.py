@@ -0,0 +1,147 @@
+"""
+Leveled, sampled, queued logging for the servers and the client
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+
+Every module logs to a category logger under "smtpop", e.g. "smtpop.smtp" for SMTP commands or "smtpop.wire" for
+the raw lines clients send. Call sites pass their arguments separately ("received command %s", command) so that a
+message below the configured level is dropped by a cached level check without ever being formatted.
+
+Records that pass are put on an in-memory queue and written to the stream by a background thread, so a request
+handler never waits on the terminal or a pipe. Chatty categories can also be sampled, keeping one in every n of their
+records below WARNING.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+ROOT = "smtpop"
+LEVEL = "INFO" # the default level: lifecycle events and problems, nothing per command or per line
+WIRE = "wire" # the category of raw protocol lines, logged only when its level is set explicitly
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+listener = None # the QueueListener writing records out, while logging is set up
+settings = None # the arguments of the last setup, reapplied in a forked child
+
+def get(category):
+    """Get the logger of a category.
+
+    :param category: the category, e.g. "smtp", "pop3", "wire", "relay", "storage", "dns" or "client".
+    :return: the logging.Logger.
+    """
+    return logging.getLogger(f"{ROOT}.{category}")
+
+class SampleFilter(logging.Filter):
+    """Lets through one in every ``every`` records below WARNING, and every record at WARNING or above.
+    """
+    def __init__(self, every):
+        """Constructor for the SampleFilter class.
+
+        :param every: keep one record in this many.
+        """
+        super().__init__()
+        self.every = max(1, every)
+        self.seen = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        """Decide whether to keep a record.
+
+        :param record: the log record.
+        :return: True to keep it.
+        """
+        if record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            self.seen += 1
+            return (self.seen - 1) % self.every == 0
+
+def parse_samples(text):
+    """Parse a sampling setting such as "wire=100,smtp=10", keeping one in every 100 wire records and 1 in every 10
+    SMTP command records.
+
+    :param text: the setting.
+    :return: a dict of category to n.
+    """
+    samples = {}
+    for part in filter(None, text.split(",")):
+        category, _, every = part.partition("=")
+        samples[category.strip()] = int(every)
+    return samples
+
+def parse_levels(text):
+    """Parse per-category levels such as "wire=DEBUG,relay=WARNING".
+
+    :param text: the setting.
+    :return: a dict of category to level name.
+    """
+    return {category.strip(): level.strip().upper() for category, _, level in (part.partition("=") for part in filter(None, text.split(",")))}
+
+def setup(level = LEVEL, levels = None, samples = None, stream = None):
+    """Configure logging for the process. Calling it again replaces the previous configuration.
+
+    :param level: the level of every category without a level of its own, e.g. "DEBUG" or "WARNING".
+    :param levels: a dict of category to the level to log it at.
+    :param samples: a dict of category to n, keeping one in every n of the category's records below WARNING.
+    :param stream: the stream to write to. Defaults to standard error.
+    """
+    global listener, settings
+    shutdown()
+    settings = (level, levels, samples, stream)
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    levels = {WIRE: "WARNING", **(levels or {})} # message content and credentials are only logged when asked for by name
+    for category, category_level in levels.items():
+        get(category).setLevel(category_level)
+    for category, every in (samples or {}).items():
+        logger = get(category)
+        for old in [f for f in logger.filters if isinstance(f, SampleFilter)]:
+            logger.removeFilter(old)
+        logger.addFilter(SampleFilter(every))
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter(FORMAT))
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+
+def shutdown():
+    """Write out every queued record and stop the writer thread.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def restart_in_child():
+    """Set logging up again in a forked child, whose copy of the writer thread does not run.
+    """
+    global listener
+    if settings is not None:
+        listener = None # the parent's thread was not copied; there is nothing to stop
+        setup(*settings)
+
+def add_arguments(parser):
+    """Add the logging options to a command line parser.
+
+    :param parser: the argparse.ArgumentParser.
+    """
+    parser.add_argument('-log-level', '--log-level', required=False, type=str.upper, default=LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"], help=f'Level to log at. DEBUG logs every command. Defaults to {LEVEL}.')
+    parser.add_argument('-log-levels', '--log-levels', required=False, type=parse_levels, default={}, help='Levels of individual categories, e.g. "smtp=DEBUG,relay=WARNING". The raw lines clients send, message content and credentials included, are only logged with "wire=DEBUG".')
+    parser.add_argument('-log-sample', '--log-sample', required=False, type=parse_samples, default={}, help='Keep only one in every n records of a category below WARNING, e.g. "wire=100,smtp=10".')
+
+def setup_from(args):
+    """Configure logging from the options added by add_arguments.
+
+    :param args: the parsed command line arguments.
+    """
+    setup(args.log_level, args.log_levels, args.log_sample)
+
+atexit.register(shutdown)
+os.register_at_fork(after_in_child=restart_in_child)
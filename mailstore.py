@@ -0,0 +1,756 @@
+"""
+Append-only mailbox storage for the SMTP server
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+"""
+from array import array
+from collections import OrderedDict
+import argparse
+import fcntl
+import hashlib
+import io
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+import uuid
+import logconfig
+import metrics
+
+ENTRY_OVERHEAD = 512 # rough in-memory cost of one index entry, including its indexed headers, in bytes
+HEADER_SCAN = 64 * 1024 # how much of a message is searched for its headers
+HEADER_INDEX_LIMIT = 1024 # longest header block copied into the index; longer ones are read from the stored message by TOP
+COPY_CHUNK = 64 * 1024
+MAX_RETRY_DELAY = 60 # longest wait, in seconds, before retrying deletions that failed to reach the disk
+REFS_SLACK = 16 # released references a body's log may hold beyond its live ones before it is compacted
+ABANDONED_AGE = 3600 # seconds after which an unchanged temporary file or references log is no longer being written
+
+log = logconfig.get("storage")
+
+storage_seconds = metrics.registry.histogram("mail_storage_seconds", "Time taken by each mailbox storage operation on disk.", ("operation",))
+bodies_stored = metrics.registry.counter("mail_bodies_stored", "Message bodies stored, by whether an identical body was already on disk.", ("outcome",))
+
+def summarize(msg):
+    """Pull the subject line out of a message's headers.
+
+    :param msg: the raw message bytes.
+    :return: the subject of the message, or "" if it has none.
+    """
+    end = msg.find(b"\r\n\r\n")
+    for line in msg[:end if end != -1 else len(msg)].split(b"\r\n"):
+        if line[:8].lower() == b"subject:":
+            return line[8:].strip().decode(errors="replace")
+    return ""
+
+def split_headers(head):
+    """Find the header block at the start of a message.
+
+    :param head: the start of the raw message bytes.
+    :return: the header block, up to and including the CRLF of its last line, and the offset of the body, just past
+        the blank line ending the headers. A message without a blank line has no headers, and its body starts at 0.
+    """
+    end = head.find(b"\r\n\r\n")
+    if end == -1:
+        return b"", 0
+    return head[:end + 2], end + 4
+
+class BodyStore:
+    """Message bodies named by the SHA-256 of their content, each stored once with a log of the entry uids using it.
+    """
+    def __init__(self, root):
+        """Constructor for the BodyStore class.
+
+        :param root: the directory under which the bodies should be kept.
+        """
+        self.root = os.path.join(root, "bodies")
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blob, ext = ""):
+        """Get the path of a body, or of its references.
+
+        :param blob: the id of the body.
+        :param ext: "" for the body itself, or "refs".
+        :return: the path of the file.
+        """
+        return os.path.join(self.root, f"{blob}.{ext}" if ext else blob)
+
+    def put(self, msg, refs):
+        """Store a body with references to it, or only add the references if an identical body is already stored.
+
+        :param msg: a binary file object holding the message, copied from its current position.
+        :param refs: the unique ids of the mailbox entries that will point at the body.
+        :return: the id of the body, which is the hex SHA-256 of its content, and its length in bytes.
+        """
+        digest = hashlib.sha256()
+        tmp = self.path(uuid.uuid4().hex, "tmp")
+        with open(tmp, "wb") as f:
+            # hashed while it is copied, so a large message is still read only once and never held in memory
+            while chunk := msg.read(COPY_CHUNK):
+                digest.update(chunk)
+                f.write(chunk)
+            length = f.tell()
+        blob = digest.hexdigest()
+        with self.locked(blob) as f:
+            duplicate = os.path.exists(self.path(blob))
+            if not duplicate:
+                f.truncate(0) # references left behind by a crash before the body was moved into place
+            self.append_refs(f, "+", refs)
+            if not duplicate:
+                os.replace(tmp, self.path(blob)) # the body only appears once its references exist
+        if duplicate:
+            os.remove(tmp)
+        bodies_stored.inc("duplicate" if duplicate else "new")
+        return blob, length
+
+    def release(self, blob, refs):
+        """Drop references to a body, removing it once none are left.
+
+        :param blob: the id of the body.
+        :param refs: the unique ids of the mailbox entries no longer pointing at it.
+        :return: True if the body was removed.
+        """
+        with self.locked(blob) as f:
+            held, records = self.read_refs(f)
+            remaining = held - set(refs)
+            if remaining:
+                self.update_refs(f, blob, held, remaining, records)
+                return False
+            return self.remove(blob)
+
+    def collect(self, dead, indexed):
+        """Drop the references of deleted or never indexed entries and remove the bodies and temporary files left
+        unused.
+
+        :param dead: the unique ids of deleted mailbox entries, from the tombstones in the indexes.
+        :param indexed: the unique ids of every entry in the indexes, deleted or not.
+        :return: the number of bodies removed.
+        """
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".tmp"):
+                try:
+                    if time.time() - os.path.getmtime(path) > ABANDONED_AGE:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if name.startswith(".") or "." in name:
+                continue
+            with self.locked(name) as f:
+                refs, records = self.read_refs(f)
+                live = refs - dead
+                if time.time() - os.fstat(f.fileno()).st_mtime > ABANDONED_AGE:
+                    # a reference no index holds is only missing its entry while a delivery is in progress
+                    live &= indexed
+                if live:
+                    self.update_refs(f, name, refs, live, records)
+                elif self.remove(name):
+                    removed += 1
+        return removed
+
+    def read_refs(self, f):
+        """Replay the log of references to a body. Must be called with the body locked.
+
+        :param f: the log, as returned by locked.
+        :return: the set of unique ids of the mailbox entries pointing at the body, and the number of records in the
+            log.
+        """
+        f.seek(0)
+        data = f.read().decode()
+        refs = set()
+        records = data.splitlines()
+        for record in records:
+            if record.startswith("+"):
+                refs.add(record[1:])
+            elif record.startswith("-"):
+                refs.discard(record[1:])
+        return refs, len(records)
+
+    def append_refs(self, f, sign, refs):
+        """Append records to the log of references to a body. Must be called with the body locked.
+
+        :param f: the log, as returned by locked.
+        :param sign: "+" to add the references, "-" to release them.
+        :param refs: the unique ids of the mailbox entries.
+        """
+        os.write(f.fileno(), "".join(f"{sign}{ref}\n" for ref in refs).encode()) # one write, appended whole
+
+    def update_refs(self, f, blob, refs, live, records):
+        """Record that some of a body's references were released, compacting its log once most of it is released
+        references. Must be called last with the body locked, since a compacted log is a new file.
+
+        :param f: the log, as returned by locked.
+        :param blob: the id of the body.
+        :param refs: the references the body had.
+        :param live: the references it has left.
+        :param records: the number of records in the log, from read_refs.
+        """
+        if live == refs:
+            return
+        if records + len(refs) - len(live) > 2 * len(live) + REFS_SLACK:
+            self.write_refs(blob, live)
+        else:
+            self.append_refs(f, "-", refs - live)
+
+    def write_refs(self, blob, refs):
+        """Atomically replace the log of references to a body with one holding only the given ones. Must be called
+        with the body locked, and last, see update_refs.
+
+        :param blob: the id of the body.
+        :param refs: the unique ids of the mailbox entries pointing at it.
+        """
+        tmp = self.path(blob, "refs.tmp")
+        with open(tmp, "w") as f:
+            f.write("".join(f"+{ref}\n" for ref in sorted(refs)))
+        os.replace(tmp, self.path(blob, "refs"))
+
+    def remove(self, blob):
+        """Remove a body and its log of references. Must be called with the body locked.
+
+        :param blob: the id of the body.
+        :return: True if the body was there to remove.
+        """
+        try:
+            os.remove(self.path(blob))
+            removed = True
+        except FileNotFoundError:
+            removed = False
+        os.remove(self.path(blob, "refs")) # unlinked while still locked, so waiting threads see it is gone
+        return removed
+
+    def locked(self, blob):
+        """Lock a body against reference updates from other threads and processes. Each body has its own lock, the
+        log of its references, so updates to different bodies proceed at once.
+
+        :param blob: the id of the body.
+        :return: the open log, created if there is none; the lock is held until it is closed, so use it in a with
+            statement.
+        """
+        path = self.path(blob, "refs")
+        while True:
+            f = open(path, "a+b")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close() # removed or compacted while this thread waited for it, so lock the file there now
+
+class MailStore:
+    """Per-user append-only mailbox indexes (``<user>.idx``) of JSON lines pointing at bodies in a BodyStore.
+    """
+    def __init__(self, root):
+        """Constructor for the MailStore class.
+
+        :param root: the domain directory under which the mailboxes should be kept.
+        """
+        self.root = os.path.join(root, "mailboxes")
+        os.makedirs(self.root, exist_ok=True)
+        self.bodies = BodyStore(self.root)
+
+    def path(self, username, ext):
+        """Get the path of one of a user's mailbox files.
+
+        :param username: the user owning the mailbox.
+        :param ext: the file extension, "idx".
+        :return: the path of the file.
+        """
+        return os.path.join(self.root, f"{urllib.parse.quote(username, safe='')}.{ext}")
+
+    def append(self, username, sender, msg):
+        """Add a message to a user's mailbox.
+
+        :param username: the user to deliver the message to.
+        :param sender: the address the message was sent from.
+        :param msg: the message, as str, bytes, or a binary file object holding it. A file is copied into the store in
+            chunks from its start, so a large message is never held in memory in one piece.
+        :return: the index entry of the stored message.
+        """
+        return self.append_many([username], sender, msg)[username]
+
+    def append_many(self, usernames, sender, msg):
+        """Deliver one message to several users' mailboxes, storing its body only once.
+
+        :param usernames: the users to deliver the message to.
+        :param sender: the address the message was sent from.
+        :param msg: the message, as str, bytes, or a binary file object holding it.
+        :return: a dict of each username to the index entry of its copy.
+        """
+        usernames = list(dict.fromkeys(usernames))
+        msg, head = open_message(msg)
+        uids = [uuid.uuid4().hex for _ in usernames]
+        with storage_seconds.time("append"):
+            blob, length = self.bodies.put(msg, uids)
+            entries = {}
+            for username, uid in zip(usernames, uids):
+                entries[username] = dict(new_entry(sender, head, length), uid=uid, blob=blob)
+                self.append_index(username, entries[username])
+        return entries
+
+    def append_index(self, username, record):
+        """Append a single record to a user's index.
+
+        :param username: the user owning the index.
+        :param record: the JSON-serializable record to append.
+        """
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode()
+        fd = os.open(self.path(username, "idx"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def read_index(self, username, offset = 0):
+        """Read the raw records of a user's index, starting from a byte offset.
+
+        :param username: the user whose index to read.
+        :param offset: the byte offset to start reading from.
+        :return: the list of complete records read, and the offset just past the last of them.
+        """
+        try:
+            with storage_seconds.time("read_index"), open(self.path(username, "idx"), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], offset
+        end = data.rfind(b"\n") + 1 # anything after the last newline is a record still being written
+        return [json.loads(line) for line in data[:end].splitlines()], offset + end
+
+    def index_size(self, username):
+        """Get the current size of a user's index file.
+
+        :param username: the user whose index to check.
+        :return: the size of the index in bytes.
+        """
+        try:
+            return os.stat(self.path(username, "idx")).st_size
+        except FileNotFoundError:
+            return 0
+
+    def read(self, username, entry):
+        """Read the body of a stored message.
+
+        :param username: the user owning the message.
+        :param entry: the index entry of the message.
+        :return: the raw message bytes.
+        """
+        with storage_seconds.time("read"), open(self.bodies.path(entry["blob"]), "rb") as f:
+            return f.read(entry["len"])
+
+
+    def top(self, username, entry, lines):
+        """Read the headers of a stored message and the first lines of its body. The headers come from the index
+        entry when they are in it, and only as much of the stored message as the requested lines span is read.
+
+        :param username: the user owning the message.
+        :param entry: the index entry of the message.
+        :param lines: the number of body lines to include.
+        :return: the header block, the blank line ending it, and up to ``lines`` lines of the body, without the
+            terminating ".".
+        """
+        headers, hlen = entry["headers"], entry["hlen"]
+        if headers is not None and lines == 0:
+            return headers.encode() + b"\r\n"
+        with storage_seconds.time("top"), open(self.bodies.path(entry["blob"]), "rb") as f:
+            if headers is None: # too long to keep in the index
+                headers, hlen = split_headers(f.read(min(entry["len"], HEADER_SCAN)))
+            else:
+                headers = headers.encode()
+            remaining = max(0, entry["len"] - hlen - 3) # the body, less the terminating ".\r\n"
+            f.seek(hlen)
+            body = bytearray()
+            end = found = 0
+            while found < lines and remaining > 0:
+                chunk = f.read(min(COPY_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                body += chunk
+                while found < lines and (nl := body.find(b"\r\n", end)) != -1:
+                    end = nl + 2
+                    found += 1
+        return headers + b"\r\n" + bytes(body[:end])
+
+    def delete(self, username, entries):
+        """Delete messages from a user's mailbox by appending tombstones to its index, then releasing the shared bodies
+        the messages pointed at.
+
+        :param username: the user owning the messages.
+        :param entries: the index entries of the messages to delete.
+        """
+        if not entries:
+            return
+        lines = "".join(json.dumps({"del": entry["uid"]}) + "\n" for entry in entries).encode()
+        with storage_seconds.time("delete"):
+            fd = os.open(self.path(username, "idx"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, lines)
+            finally:
+                os.close(fd)
+            # only once the tombstones are down, so a crash in between leaks a body rather than losing a live one
+            shared = {}
+            for entry in entries:
+                shared.setdefault(entry["blob"], []).append(entry["uid"])
+            for blob, uids in shared.items():
+                self.bodies.release(blob, uids)
+
+    def collect(self):
+        """Garbage collect the bodies no live mailbox entry points at any more, see BodyStore.collect.
+
+        :return: the number of bodies removed.
+        """
+        dead, indexed = set(), set()
+        for name in os.listdir(self.root):
+            if name.endswith(".idx"):
+                records, _ = self.read_index(urllib.parse.unquote(name[:-len(".idx")]))
+                for record in records:
+                    if "del" in record:
+                        dead.add(record["del"])
+                    else:
+                        indexed.add(record["uid"])
+        return self.bodies.collect(dead, indexed)
+
+    def migrate_json(self, filename):
+        """Migrate a legacy emails.json "database" into per-user mailboxes, once per store.
+
+        :param filename: the path of the legacy emails.json file.
+        :return: the number of messages migrated.
+        """
+        marker = os.path.join(self.root, ".migrated")
+        with open(os.path.join(self.root, ".migrate.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX) # only one worker process may run the migration
+            if os.path.exists(marker) or not os.path.exists(filename):
+                return 0
+            with open(filename, "r") as f:
+                emails = json.load(f)
+            count = 0
+            for username, user_emails in emails.items():
+                for email in user_emails:
+                    self.append(username, email["FROM"], email["msg"])
+                    count += 1
+            with open(marker, "w") as f:
+                f.write(f"{filename}\n")
+            return count
+
+def open_message(msg):
+    """Get a message ready to be copied into storage.
+
+    :param msg: the message, as str, bytes, or a binary file object holding it.
+    :return: a binary file object positioned at the start of the message, and the start of the message, where its
+        headers are searched for.
+    """
+    if isinstance(msg, str):
+        msg = msg.encode()
+    if isinstance(msg, (bytes, bytearray)):
+        msg = io.BytesIO(msg)
+    msg.seek(0)
+    head = msg.read(HEADER_SCAN)
+    msg.seek(0)
+    return msg, head
+
+def new_entry(sender, head, length):
+    """Build the index entry of a newly stored message.
+
+    :param sender: the address the message was sent from.
+    :param head: the start of the message.
+    :param length: the length of the message in bytes.
+    :return: the index entry, with a new unique id.
+    """
+    headers, hlen = split_headers(head)
+    return {"uid": uuid.uuid4().hex, "len": length, "from": sender, "subject": summarize(head),
+            "ts": int(time.time()), "hlen": hlen,
+            "headers": headers.decode(errors="replace") if len(headers) <= HEADER_INDEX_LIMIT else None}
+
+def apply_records(entries, records):
+    """Apply raw index records to a dict of live entries.
+
+    :param entries: the dict of live entries keyed by unique id, updated in place.
+    :param records: the records to apply, oldest first.
+    """
+    for record in records:
+        if "del" in record:
+            entries.pop(record["del"], None)
+        else:
+            entries.setdefault(record["uid"], record)
+
+class Maildrop:
+    """A POP3 session's view of a mailbox, with its message sizes and totals kept apart from the bodies.
+    """
+    def __init__(self, entries):
+        """Constructor for the Maildrop class.
+
+        :param entries: the index entries of the mailbox, oldest first.
+        """
+        self.entries = entries
+        self.sizes = array("Q", (entry["len"] for entry in entries))
+        self.deleted = bytearray(len(entries))
+        self.count = len(entries)
+        self.octets = sum(self.sizes)
+
+    def get(self, num):
+        """Get the index entry of a message by its message number.
+
+        :param num: the 1-based message number, as an int or a string of decimal digits.
+        :return: the index entry, or None if there is no such message or it is marked for deletion.
+        """
+        num = str(num).strip()
+        if not num.isdecimal() or not 1 <= int(num) <= len(self.entries) or self.deleted[int(num) - 1]:
+            return None
+        return self.entries[int(num) - 1]
+
+    def delete(self, num):
+        """Mark a message for deletion.
+
+        :param num: the 1-based message number.
+        :return: True if the message was marked, False if there is no such message.
+        """
+        if self.get(num) is None:
+            return False
+        num = int(str(num).strip())
+        self.deleted[num - 1] = 1
+        self.count -= 1
+        self.octets -= self.sizes[num - 1]
+        return True
+
+    def reset(self):
+        """Unmark every message marked for deletion.
+        """
+        self.deleted = bytearray(len(self.entries))
+        self.count = len(self.entries)
+        self.octets = sum(self.sizes)
+
+    def listing(self):
+        """List the messages not marked for deletion.
+
+        :return: a list of (message number, octet size) tuples.
+        """
+        return [(i + 1, size) for i, size in enumerate(self.sizes) if not self.deleted[i]]
+
+    def uid(self, num):
+        """Get the unique id of a message by its message number.
+
+        :param num: the 1-based message number.
+        :return: the unique id, or None if there is no such message or it is marked for deletion.
+        """
+        entry = self.get(num)
+        return entry["uid"] if entry is not None else None
+
+    def deleted_entries(self):
+        """Get the index entries of every message marked for deletion.
+
+        :return: the list of index entries.
+        """
+        return [self.entries[i] for i, deleted in enumerate(self.deleted) if deleted]
+
+class MailboxCache:
+    """Process-wide LRU cache of mailboxes and message bodies in front of a MailStore, writing deletions behind.
+    """
+    def __init__(self, store, max_bytes = 64 * 1024 * 1024):
+        """Constructor for the MailboxCache class.
+
+        :param store: the MailStore backing this cache.
+        :param max_bytes: the approximate memory cap of the cache, in bytes.
+        """
+        self.store = store
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.mailboxes = OrderedDict() # username -> {"entries": {uid: entry}, "offset": int, "bodies": OrderedDict of uid -> bytes, least recently read first, "size": int}
+        self.pending = {} # username -> set of uids deleted in memory but not yet on disk
+        self.lock = threading.Lock()
+        self.writes = queue.Queue()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def get(self, username):
+        """Get the live index entries of a user's mailbox, loading it from disk on a miss.
+
+        :param username: the user whose mailbox to get.
+        :return: a list of the mailbox's index entries, oldest first.
+        """
+        with self.lock:
+            # load under the lock so that a delivery cannot land between reading the index and caching it
+            mailbox = self.mailboxes.get(username)
+            if mailbox is None:
+                mailbox = self.mailboxes[username] = {"entries": {}, "offset": 0, "bodies": OrderedDict(), "size": 0}
+            else:
+                self.mailboxes.move_to_end(username)
+            if self.store.index_size(username) != mailbox["offset"]:
+                self.refresh(username, mailbox)
+            return list(mailbox["entries"].values())
+
+    def refresh(self, username, mailbox):
+        """Apply the index records added since a cached mailbox was last read. Must be called with the lock held.
+
+        :param username: the user owning the mailbox.
+        :param mailbox: the cached mailbox to bring up to date.
+        """
+        records, mailbox["offset"] = self.store.read_index(username, mailbox["offset"])
+        before = len(mailbox["entries"])
+        apply_records(mailbox["entries"], records)
+        for uid in self.pending.get(username, ()):
+            mailbox["entries"].pop(uid, None)
+        self.grow(mailbox, (len(mailbox["entries"]) - before) * ENTRY_OVERHEAD)
+
+    def deliver(self, username, sender, msg):
+        """Store a newly received message, adding it to the cached mailbox if there is one.
+
+        :param username: the user to deliver the message to.
+        :param sender: the address the message was sent from.
+        :param msg: the message, as str, bytes, or a binary file object holding it.
+        :return: the index entry of the stored message.
+        """
+        entry = self.store.append(username, sender, msg) # outside the lock, so a large message cannot stall readers
+        with self.lock:
+            self.add_entry(username, entry)
+        return entry
+
+    def deliver_many(self, usernames, sender, msg):
+        """Store a newly received message for several users, keeping one copy of its body, see MailStore.append_many.
+
+        :param usernames: the users to deliver the message to.
+        :param sender: the address the message was sent from.
+        :param msg: the message, as str, bytes, or a binary file object holding it.
+        :return: a dict of each username to the index entry of its copy.
+        """
+        entries = self.store.append_many(usernames, sender, msg)
+        with self.lock:
+            for username, entry in entries.items():
+                self.add_entry(username, entry)
+        return entries
+
+    def add_entry(self, username, entry):
+        """Add a newly stored message to a user's cached mailbox, if it is cached. Must be called with the lock held.
+        The store is written without the lock, so a refresh may already have read the message from the index.
+
+        :param username: the user the message was delivered to.
+        :param entry: the index entry of the message.
+        """
+        mailbox = self.mailboxes.get(username)
+        if mailbox is not None and entry["uid"] not in mailbox["entries"]:
+            mailbox["entries"][entry["uid"]] = entry
+            self.grow(mailbox, ENTRY_OVERHEAD)
+
+    def read(self, username, entry):
+        """Read the body of a message, from memory if it has been read before.
+
+        :param username: the user owning the message.
+        :param entry: the index entry of the message.
+        :return: the raw message bytes.
+        """
+        with self.lock:
+            mailbox = self.mailboxes.get(username)
+            if mailbox is not None and entry["uid"] in mailbox["bodies"]:
+                self.mailboxes.move_to_end(username)
+                mailbox["bodies"].move_to_end(entry["uid"])
+                return mailbox["bodies"][entry["uid"]]
+        body = self.store.read(username, entry)
+        with self.lock:
+            mailbox = self.mailboxes.get(username)
+            if mailbox is not None and len(body) < self.max_bytes // 4 and entry["uid"] not in mailbox["bodies"]:
+                mailbox["bodies"][entry["uid"]] = body
+                self.grow(mailbox, len(body))
+        return body
+
+    def top(self, username, entry, lines):
+        """Read the headers of a message and the first lines of its body, see MailStore.top.
+
+        :param username: the user owning the message.
+        :param entry: the index entry of the message.
+        :param lines: the number of body lines to include.
+        :return: the headers and the first lines of the body.
+        """
+        return self.store.top(username, entry, lines)
+
+    def delete(self, username, entries):
+        """Delete messages from a user's mailbox. The tombstones are written to disk, and the shared bodies released,
+        in the background.
+
+        :param username: the user owning the messages.
+        :param entries: the index entries of the messages to delete.
+        """
+        entries = list({entry["uid"]: entry for entry in entries}.values())
+        uids = {entry["uid"] for entry in entries}
+        if not uids:
+            return
+        with self.lock:
+            self.pending.setdefault(username, set()).update(uids)
+            mailbox = self.mailboxes.get(username)
+            if mailbox is not None:
+                freed = sum(ENTRY_OVERHEAD for uid in uids if mailbox["entries"].pop(uid, None) is not None)
+                freed += sum(len(mailbox["bodies"].pop(uid, b"")) for uid in uids)
+                self.grow(mailbox, -freed)
+        self.writes.put((username, entries))
+
+    def grow(self, mailbox, delta):
+        """Account for a change in the size of a cached mailbox. Must be called with the lock held.
+
+        :param mailbox: the cached mailbox that changed.
+        :param delta: the change in size, in bytes.
+        """
+        mailbox["size"] += delta
+        self.size += delta
+        self.evict()
+
+    def evict(self):
+        """Evict least recently used mailboxes, then bodies, until the cache is under its memory cap. Must be called with
+        the lock held.
+        """
+        while self.size > self.max_bytes and len(self.mailboxes) > 1:
+            _, mailbox = self.mailboxes.popitem(last=False)
+            self.size -= mailbox["size"]
+        if self.size > self.max_bytes and self.mailboxes:
+            mailbox = next(reversed(self.mailboxes.values()))
+            while self.size > self.max_bytes and mailbox["bodies"]:
+                _, body = mailbox["bodies"].popitem(last=False)
+                mailbox["size"] -= len(body)
+                self.size -= len(body)
+
+    def flush_loop(self):
+        """Write queued tombstones to disk, retrying failed writes with a growing delay. Runs on the flusher thread.
+        """
+        delay = 1
+        while True:
+            username, entries = self.writes.get()
+            try:
+                self.store.delete(username, entries)
+            except Exception:
+                log.exception("Could not write deletions from %s's mailbox, retrying in %d s", username, delay)
+                self.writes.put((username, entries)) # before task_done, so flush keeps waiting for it
+                self.writes.task_done()
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            delay = 1
+            with self.lock:
+                pending = self.pending.get(username)
+                if pending is not None:
+                    pending -= {entry["uid"] for entry in entries}
+                    if not pending:
+                        del self.pending[username]
+            self.writes.task_done()
+
+    def flush(self, timeout = None):
+        """Block until every queued write has reached the disk.
+
+        :param timeout: the longest to wait, in seconds, or None to wait for as long as it takes.
+        :return: True if every write reached the disk, False if some were still failing when the timeout ran out.
+        """
+        with self.writes.all_tasks_done:
+            return self.writes.all_tasks_done.wait_for(lambda: not self.writes.unfinished_tasks, timeout)
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a domain's emails.json into per-user append-only mailboxes.")
+    parser.add_argument("--dir", "-d", required=True, help="The domain directory to migrate, e.g. abeersclass.")
+    parser.add_argument("--gc", action="store_true", help="Also remove stored message bodies that no mailbox points at any more.")
+    args = parser.parse_args()
+
+    store = MailStore(args.dir)
+    print(f"Migrated {store.migrate_json(os.path.join(args.dir, 'emails.json'))} messages")
+    if args.gc:
+        print(f"Removed {store.collect()} unreferenced message bodies")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Metrics registry for the SMTP/POP3 server, exposed in the Prometheus text format
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    """A count that only goes up, kept separately for each combination of label values.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, labels = ()):
+        """Constructor for the Counter class.
+
+        :param name: the metric name.
+        :param help: a one-line description of the metric.
+        :param labels: the names of the labels each count is kept under.
+        """
+        self.name = name
+        self.family = f"{name}_total" # counters are exposed with the conventional suffix
+        self.help = help
+        self.labels = labels
+        self.values = {} # tuple of label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *values, amount = 1):
+        """Add to the count.
+
+        :param values: the label values, one per label.
+        :param amount: how much to add.
+        """
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self):
+        """Get the current counts.
+
+        :return: a list of (name suffix, label values, value) tuples.
+        """
+        with self.lock:
+            return [("", values, count) for values, count in sorted(self.values.items())]
+
+class Gauge:
+    """A value that is read when the metrics are rendered, by calling back into whatever owns it, so keeping it
+    costs nothing while the server runs. Several owners, such as several servers in one process, can each add a
+    callback; their values are summed.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels = ()):
+        """Constructor for the Gauge class.
+
+        :param name: the metric name.
+        :param help: a one-line description of the metric.
+        :param labels: the names of the labels the value is reported under.
+        """
+        self.name = self.family = name
+        self.help = help
+        self.labels = labels
+        self.callbacks = []
+
+    def track(self, callback):
+        """Add a callback to read the value from.
+
+        :param callback: called with no arguments; returns a dict of label values tuple -> value, or with no labels a
+            plain number.
+        """
+        self.callbacks.append(callback)
+
+    def samples(self):
+        """Get the current value of the gauge.
+
+        :return: a list of (name suffix, label values, value) tuples.
+        """
+        totals = {}
+        for callback in list(self.callbacks):
+            values = callback()
+            for key, value in (values.items() if isinstance(values, dict) else [((), values)]):
+                totals[key] = totals.get(key, 0) + value
+        return [("", values, value) for values, value in sorted(totals.items())]
+
+class Histogram:
+    """Counts of observed durations by bucket, kept separately for each combination of label values. The number of
+    observations doubles as a counter of the events timed.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        """Constructor for the Histogram class.
+
+        :param name: the metric name.
+        :param help: a one-line description of the metric.
+        :param labels: the names of the labels each histogram is kept under.
+        :param buckets: the upper bounds of the buckets, in increasing order.
+        """
+        self.name = self.family = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {} # tuple of label values -> [count per bucket, with one more for +Inf, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, *values):
+        """Record one observation.
+
+        :param seconds: the observed duration.
+        :param values: the label values, one per label.
+        """
+        i = bisect_left(self.buckets, seconds)
+        with self.lock:
+            state = self.values.get(values)
+            if state is None:
+                state = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += seconds
+
+    def time(self, *values):
+        """Time a block of code: ``with histogram.time("append"): ...``.
+
+        :param values: the label values, one per label.
+        :return: a context manager that observes how long its block took.
+        """
+        return Timer(self, values)
+
+    def samples(self):
+        """Get the current histograms, with cumulative bucket counts.
+
+        :return: a list of (name suffix, label values, value) tuples, where the bucket samples' label values end with
+            the bucket's upper bound.
+        """
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in sorted(self.values.items())]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                samples.append(("_bucket", key + (bound,), cumulative))
+            samples.append(("_sum", key, total))
+            samples.append(("_count", key, cumulative))
+        return samples
+
+class Timer:
+    """Context manager returned by Histogram.time.
+    """
+    __slots__ = ("histogram", "values", "started")
+
+    def __init__(self, histogram, values):
+        """Constructor for the Timer class.
+
+        :param histogram: the Histogram to record into.
+        :param values: the label values to record under.
+        """
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.values)
+        return False
+
+class Registry:
+    """Every metric of the process, in registration order.
+    """
+    def __init__(self):
+        """Constructor for the Registry class.
+        """
+        self.metrics = {}
+
+    def register(self, metric):
+        """Add a metric, or get the one already registered under its name.
+
+        :param metric: the Counter, Gauge or Histogram to add.
+        :return: the registered metric.
+        """
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels = ()):
+        """Register a Counter, see its constructor."""
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels = ()):
+        """Register a Gauge, see its constructor."""
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        """Register a Histogram, see its constructor."""
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format.
+
+        :return: the text.
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.family} {metric.help}")
+            lines.append(f"# TYPE {metric.family} {metric.kind}")
+            for suffix, values, value in metric.samples():
+                names = metric.labels + ("le",) if suffix == "_bucket" else metric.labels
+                labels = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+                lines.append(f"{metric.family}{suffix}{{{labels}}} {value}" if labels else f"{metric.family}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+def escape(value):
+    """Escape a label value for the text format.
+
+    :param value: the label value.
+    :return: the escaped value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+registry = Registry() # the metrics of this process
+
+def serve(port, host = "127.0.0.1", source = registry):
+    """Serve the metrics over HTTP from a background thread, for Prometheus or curl to scrape.
+
+    :param port: the port to listen on.
+    :param host: the address to listen on. Defaults to loopback, so the stats are only visible locally.
+    :param source: the Registry to serve.
+    :return: the HTTP server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = source.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # scrapes are frequent and uninteresting
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
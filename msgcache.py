@@ -0,0 +1,99 @@
+"""
+Client-side offline cache of POP3 messages
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+"""
+import os
+import sqlite3
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".smtpop") # where each account's cache file is kept
+
+class MessageCache:
+    """The messages of one account that the client has already downloaded, kept in a sqlite database and keyed by the
+    unique id the server gives each message in its UIDL response.
+
+    Headers are stored for every message the client has listed and full messages for every message it has viewed, so
+    once a message is cached, listing or reading it needs nothing from the server. The server's unique ids never
+    change, which is what lets the cache outlive the message numbers of a single POP3 session.
+    """
+    def __init__(self, path):
+        """Constructor for the MessageCache class.
+
+        :param path: the path of the database file, or ":memory:" for a cache that lasts only as long as the client.
+        """
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (uid TEXT PRIMARY KEY, headers TEXT NOT NULL, message TEXT)")
+        self.db.commit()
+
+    @classmethod
+    def for_account(cls, cache_dir, username, domain):
+        """Open the cache of an account.
+
+        :param cache_dir: the directory holding the cache files, or None to cache in memory only.
+        :param username: the account's username.
+        :param domain: the account's domain.
+        :return: the MessageCache.
+        """
+        if cache_dir is None:
+            return cls(":memory:")
+        return cls(os.path.join(cache_dir, f"{username}@{domain}.sqlite3"))
+
+    def uids(self):
+        """Get the unique id of every cached message.
+
+        :return: the set of unique ids.
+        """
+        return {uid for uid, in self.db.execute("SELECT uid FROM messages")}
+
+    def retain(self, uids):
+        """Drop every cached message the server no longer has.
+
+        :param uids: the unique ids of the messages still on the server.
+        :return: the number of messages dropped.
+        """
+        gone = self.uids() - set(uids)
+        self.db.executemany("DELETE FROM messages WHERE uid = ?", [(uid,) for uid in gone])
+        self.db.commit()
+        return len(gone)
+
+    def add_headers(self, headers):
+        """Cache the headers of newly listed messages.
+
+        :param headers: a dict mapping each message's unique id to the TOP response holding its headers.
+        """
+        self.db.executemany("INSERT OR IGNORE INTO messages (uid, headers) VALUES (?, ?)", headers.items())
+        self.db.commit()
+
+    def headers(self, uid):
+        """Get the cached headers of a message.
+
+        :param uid: the message's unique id.
+        :return: the TOP response holding the headers, or None if the message is not cached.
+        """
+        row = self.db.execute("SELECT headers FROM messages WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else None
+
+    def add_message(self, uid, message):
+        """Cache a whole message.
+
+        :param uid: the message's unique id.
+        :param message: the RETR response holding the message.
+        """
+        self.db.execute("INSERT INTO messages (uid, headers, message) VALUES (?, ?, ?) "
+                        "ON CONFLICT (uid) DO UPDATE SET message = excluded.message", (uid, message, message))
+        self.db.commit()
+
+    def message(self, uid):
+        """Get a cached message.
+
+        :param uid: the message's unique id.
+        :return: the RETR response holding the message, or None if it has not been downloaded.
+        """
+        row = self.db.execute("SELECT message FROM messages WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        """Close the database.
+        """
+        self.db.close()
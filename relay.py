@@ -0,0 +1,367 @@
+"""
+Outbound relay queue for mail addressed to other domains
+Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
+"""
+import heapq
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+import dns.dns
+import logconfig
+import metrics
+import smtp_client
+
+log = logconfig.get("relay")
+
+queue_depth = metrics.registry.gauge("relay_queue_depth", "Messages waiting in or being relayed from the outbound queue.")
+attempts = metrics.registry.counter("relay_attempts", "Relay attempts, by outcome: delivered, to be retried, or given up on and bounced.", ("outcome",))
+
+class RelayPool:
+    """Authenticated relay sessions to other servers, kept open between messages and keyed by destination address.
+    """
+    def __init__(self, domain, password, idle_timeout = 60):
+        """Constructor for the RelayPool class.
+
+        :param domain: the domain of the server relaying the messages.
+        :param password: the password the relaying server authenticates to other servers with.
+        :param idle_timeout: how long an unused session is kept open, in seconds.
+        """
+        self.domain = domain
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.idle = {} # (ip, port) -> list of (EmailClient, time it was last used)
+        self.lock = threading.Lock()
+        threading.Thread(target=self.reap, daemon=True).start()
+
+    def send(self, dst_addr, sender, rcpts, msg):
+        """Send one message to a server over a pooled session.
+
+        :param dst_addr: the (ip, port) of the destination server.
+        :param sender: the address the message is from.
+        :param rcpts: the addresses the message is for, or a single address.
+        :param msg: the message, including its terminating ".", as a string or a binary file streamed from its start.
+        :return: None if the message was accepted, or a description of why it was not.
+        """
+        from_address = f"{sender.split("@")[0]}@{self.domain}"
+        rcpt_domain = (rcpts if isinstance(rcpts, str) else rcpts[0]).rpartition("@")[2]
+        session = self.acquire(dst_addr)
+        reused = session is not None
+        while True:
+            if session is None:
+                session = smtp_client.EmailClient(timeout=30)
+                # the server account of the destination domain, which is the one its server knows
+                if not session.relay_login(dst_addr, self.domain, f"server@{rcpt_domain}", self.password):
+                    return f"could not open a session with {dst_addr[0]}:{dst_addr[1]}"
+            try:
+                accepted = session.send_message(from_address, rcpts, msg)
+            except OSError:
+                accepted = False
+            if accepted:
+                self.release(dst_addr, session)
+                return None
+            session.close()
+            if not reused:
+                return f"{dst_addr[0]}:{dst_addr[1]} did not accept the message"
+            # the remote end may have closed an idle session; try once more on a fresh one
+            session, reused = None, False
+
+    def acquire(self, dst_addr):
+        """Take an idle session to a destination out of the pool.
+
+        :param dst_addr: the (ip, port) of the destination server.
+        :return: an authenticated EmailClient, or None if there is no idle session.
+        """
+        with self.lock:
+            sessions = self.idle.get(dst_addr)
+            if sessions:
+                return sessions.pop()[0]
+        return None
+
+    def release(self, dst_addr, session):
+        """Return a session to the pool after a successful transaction.
+
+        :param dst_addr: the (ip, port) of the destination server.
+        :param session: the EmailClient to return.
+        """
+        with self.lock:
+            self.idle.setdefault(dst_addr, []).append((session, time.monotonic()))
+
+    def reap(self):
+        """Close sessions that have been idle for too long. Runs on a background thread.
+        """
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            expired = []
+            with self.lock:
+                cutoff = time.monotonic() - self.idle_timeout
+                for dst_addr, sessions in list(self.idle.items()):
+                    expired += [session for session, used in sessions if used < cutoff]
+                    self.idle[dst_addr] = [(session, used) for session, used in sessions if used >= cutoff]
+                    if not self.idle[dst_addr]:
+                        del self.idle[dst_addr]
+            for session in expired:
+                session.quit()
+
+    def invalidate(self, dst_addr):
+        """Close every idle session to a destination.
+
+        :param dst_addr: the (ip, port) of the destination server.
+        """
+        with self.lock:
+            sessions = self.idle.pop(dst_addr, [])
+        for session, _ in sessions:
+            session.close()
+
+class RelayQueue:
+    """Persistent outbound queue, spooled to disk as a ``.eml`` message and a JSON entry, drained by relay threads.
+    """
+    def __init__(self, spool_dir, domain, password, dns_ip, dns_port = 8080, workers = 4, per_domain = 2, max_attempts = 8, base_delay = 5, max_delay = 3600, bounce = None):
+        """Constructor for the RelayQueue class.
+
+        :param spool_dir: the directory to keep queued messages in.
+        :param domain: the domain of the server relaying the messages.
+        :param password: the password the relaying server authenticates to other servers with.
+        :param dns_ip: the IP of the DNS server.
+        :param dns_port: the port of the DNS server.
+        :param workers: the number of relay threads.
+        :param per_domain: the maximum number of messages relayed to a single domain at once.
+        :param max_attempts: the number of attempts after which a message is given up on.
+        :param base_delay: the delay before the first retry, in seconds. Each later retry waits twice as long.
+        :param max_delay: the longest delay between two retries, in seconds.
+        :param bounce: called with the spool entry and the last error of each message that is given up on.
+        """
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        os.makedirs(self.failed_dir, exist_ok=True)
+        self.domain = domain
+        self.password = password
+        self.dns_ip = dns_ip
+        self.dns_port = dns_port
+        self.per_domain = per_domain
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bounce = bounce
+        self.pool = RelayPool(domain, password)
+        self.suffix = f".{os.getpid()}"
+        self.schedule = {} # destination domain -> heap of (due time, spool path)
+        self.heads = [] # heap of (due time, domain) of the first message of each domain below its limit; may be stale
+        self.waiting = 0 # messages in self.schedule
+        self.active = {} # destination domain -> number of messages being relayed to it
+        self.cond = threading.Condition()
+        queue_depth.track(self.depth)
+        self.recover()
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def enqueue(self, sender, rcpts, msg):
+        """Queue a message for relaying.
+
+        :param sender: the address the message is from.
+        :param rcpts: the addresses the message is for, all in the same domain, or a single address. They are relayed
+            together, in one session.
+        :param msg: the message, including its terminating ".", as a string or a binary file copied from its start.
+        :return: the path of the spool file.
+        """
+        rcpts = [rcpts] if isinstance(rcpts, str) else list(rcpts)
+        base = uuid.uuid4().hex
+        with open(os.path.join(self.spool_dir, f"{base}.eml"), "wb") as f: # before the entry, which is what gets sent
+            if isinstance(msg, str):
+                f.write(msg.encode())
+            else:
+                msg.seek(0)
+                shutil.copyfileobj(msg, f)
+        entry = {"from": sender, "to": rcpts, "domain": rcpts[0].split("@")[-1], "body": f"{base}.eml", "attempts": 0,
+                 "queued": time.time(), "error": ""}
+        path = os.path.join(self.spool_dir, f"{base}.json{self.suffix}")
+        self.save(path, entry)
+        self.schedule_at(time.time(), path, entry["domain"])
+        return path
+
+    def depth(self):
+        """Get the number of messages waiting in or being relayed from this queue.
+
+        :return: the number of messages.
+        """
+        with self.cond:
+            return self.waiting + sum(self.active.values())
+
+    def save(self, path, entry):
+        """Atomically write a spool entry to disk.
+
+        :param path: the path of the spool file.
+        :param entry: the spool entry to write.
+        """
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def recover(self):
+        """Claim and schedule the spool files left behind by processes that are no longer running.
+        """
+        domains = set()
+        names = os.listdir(self.spool_dir)
+        queued = {name.rpartition(".json")[0] for name in names}
+        for name in names:
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith(".eml"):
+                try:
+                    if name[:-len(".eml")] not in queued and time.time() - os.path.getmtime(path) > 3600:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            base, _, owner = name.rpartition(".json")
+            if not base or owner.endswith(".tmp") or (owner and alive(owner[1:])):
+                continue
+            claimed = os.path.join(self.spool_dir, f"{base}.json{self.suffix}")
+            try:
+                os.rename(path, claimed) # atomic, so only one recovering process wins each file
+                with open(claimed, "r") as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            self.schedule_at(time.time(), claimed, entry["domain"])
+            domains.add(entry["domain"])
+        if domains:
+            # warm the resolver cache in the background so relay threads starting on the backlog skip the lookups
+            threading.Thread(target=dns.dns.dns_lookup_many, args=(self.dns_ip, self.dns_port, domains), daemon=True).start()
+
+    def schedule_at(self, due, path, domain):
+        """Schedule a spool file to be relayed.
+
+        :param due: the time at which the message should next be tried.
+        :param path: the path of the spool file.
+        :param domain: the domain the message is for.
+        """
+        with self.cond:
+            messages = self.schedule.setdefault(domain, [])
+            heapq.heappush(messages, (due, path))
+            self.waiting += 1
+            if messages[0][1] == path:
+                self.offer(domain)
+            self.cond.notify()
+
+    def offer(self, domain):
+        """Make the first message of a domain available to the relay threads, unless the domain is at its concurrency
+        limit or has nothing waiting. Must be called with self.cond held.
+
+        :param domain: the destination domain.
+        """
+        messages = self.schedule.get(domain)
+        if messages and self.active.get(domain, 0) < self.per_domain:
+            heapq.heappush(self.heads, (messages[0][0], domain))
+
+    def next_message(self):
+        """Wait for a message that is due and whose domain is below its concurrency limit, and take it.
+
+        :return: the path of the spool file and the domain it is for.
+        """
+        with self.cond:
+            while True:
+                while self.heads:
+                    due, domain = self.heads[0]
+                    messages = self.schedule.get(domain)
+                    if messages and messages[0][0] == due and self.active.get(domain, 0) < self.per_domain:
+                        break
+                    heapq.heappop(self.heads) # superseded by an earlier message, or the domain is at its limit
+                else:
+                    self.cond.wait()
+                    continue
+                now = time.time()
+                if due > now:
+                    self.cond.wait(due - now)
+                    continue
+                heapq.heappop(self.heads)
+                _, path = heapq.heappop(messages)
+                self.waiting -= 1
+                if not messages:
+                    del self.schedule[domain]
+                self.active[domain] = self.active.get(domain, 0) + 1
+                self.offer(domain)
+                return path, domain
+
+    def work(self):
+        """Relay messages until the process exits. Runs on each relay thread.
+        """
+        while True:
+            path, domain = self.next_message()
+            try:
+                self.process(path)
+            except Exception:
+                log.exception("Relay error for %s", path)
+            finally:
+                with self.cond:
+                    self.active[domain] -= 1
+                    if self.active[domain] == self.per_domain - 1:
+                        self.offer(domain) # it was at its limit, so its first message was withdrawn
+                    self.cond.notify_all()
+
+    def process(self, path):
+        """Make one attempt at relaying a spooled message, rescheduling or bouncing it if the attempt fails.
+
+        :param path: the path of the spool file.
+        """
+        with open(path, "r") as f:
+            entry = json.load(f)
+        with open(os.path.join(self.spool_dir, entry["body"]), "rb") as msg:
+            error = self.send(entry, msg)
+        if error is None:
+            os.remove(path)
+            os.remove(os.path.join(self.spool_dir, entry["body"]))
+            attempts.inc("delivered")
+            return
+        entry["attempts"] += 1
+        entry["error"] = error
+        if entry["attempts"] >= self.max_attempts:
+            os.replace(path, os.path.join(self.failed_dir, os.path.basename(path).rpartition(".json")[0] + ".json"))
+            os.replace(os.path.join(self.spool_dir, entry["body"]), os.path.join(self.failed_dir, entry["body"]))
+            log.warning("Giving up on relaying to %s: %s", entry["to"], error)
+            attempts.inc("bounced")
+            if self.bounce is not None:
+                self.bounce(entry, error)
+            return
+        self.save(path, entry)
+        attempts.inc("retried")
+        delay = min(self.max_delay, self.base_delay * 2 ** (entry["attempts"] - 1))
+        self.schedule_at(time.time() + delay * random.uniform(0.8, 1.2), path, entry["domain"])
+
+    def send(self, entry, msg):
+        """Relay a message to the servers responsible for its domain, trying each in turn until one accepts it.
+
+        :param entry: the spool entry of the message.
+        :param msg: the message, as an open binary file.
+        :return: None if the message was accepted, or a description of why it was not.
+        """
+        endpoints = dns.dns.dns_resolve(self.dns_ip, self.dns_port, entry["domain"])
+        if not endpoints:
+            return f"could not resolve {entry["domain"]}"
+        for dst_addr in endpoints:
+            error = self.pool.send(dst_addr, entry["from"], entry["to"], msg)
+            if error is None:
+                return None
+            dns.dns.dns_report_failure(entry["domain"], dst_addr) # try the domain's other servers first next time
+            self.pool.invalidate(dst_addr) # its other idle sessions are likely as dead as the one that failed
+        dns.dns.dns_invalidate(entry["domain"]) # every server failed; they may have moved, so resolve them again
+        return error
+
+def alive(pid):
+    """Check whether a process is running.
+
+    :param pid: the process id, as a string.
+    :return: True if a process with that id exists.
+    """
+    if not pid.isnumeric():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -5,30 +5,62 @@ Author: Landon Spitzer - lbs9440@rit.edu and Caleb Naeger - cmn4315@rit.edu
 import socket
 import base64
 import hashlib
+import logging
 import argparse
+import getpass
+import json
+import os
+import threading
+import time
+import weakref
 import dns.dns
+import logconfig
+from linereader import LineReader
+from msgcache import CACHE_DIR, MessageCache
 from prompt_toolkit import prompt  # for multiline input
 
 DOMAIN = 'abeersclass.com'
+POP_WINDOW = 16 # POP3 commands sent ahead of their responses
+POP3_PORT = 8110
+CONNECT_TIMEOUT = 5 # seconds to wait for a server to accept a connection before trying the next one
+BULK_SESSIONS = 4 # concurrent SMTP sessions used by send_many
+PASSWORD_ENV = "SMTPOP_PASSWORD" # environment variable bulk mode reads the password from
+
+log = logconfig.get("client")
 
 class EmailClient:
     """ An email client that supports SMTP and POP3, to send and receive emails respectively. """
-    def __init__(self, dns_ip = "192.168.124.32", debug_mode=False):
+    def __init__(self, dns_ip = "192.168.124.32", debug_mode=False, timeout=None, pop_window=POP_WINDOW, cache_dir=CACHE_DIR, pop_port=POP3_PORT):
         """
         Initialize the email client.
         
         :param dns_ip: The IP address of the DNS server.
-        :param debug_mode: Enable debug mode.
+        :param debug_mode: Log the exchange with the servers, at DEBUG level in the "client" logging category.
+        :param timeout: Socket timeout in seconds for server connections, or None to block.
+        :param pop_window: The number of POP3 commands pop3_pipeline keeps in flight.
+        :param cache_dir: The directory to keep each account's offline message cache in, or None to cache in memory.
+        :param pop_port: The port the servers accept POP3 connections on.
         """
         self.dns_ip = dns_ip
         self.debug_mode = debug_mode
+        if debug_mode:
+            log.setLevel(logging.DEBUG)
+        self.timeout = timeout
         self.username = ""
         self.password = ""
         self.password_hash = ""
         self.s = None
+        self.pipelining = False
         self.pop_socket = None
+        self.pop_window = pop_window
+        self.cache_dir = cache_dir
+        self.cache = None
+        self.uids = {} # message number -> unique id of every message on the server this POP3 session
+        self.deleted = set() # message numbers marked for deletion this POP3 session
+        self.readers = weakref.WeakKeyDictionary() # socket -> the LineReader buffering what was received from it
         self.pop_ip = 'localhost'
-        self.pop_port = 8110
+        self.endpoints = []
+        self.pop_port = pop_port
 
     def run(self):
         """ Run the email client. 
@@ -78,7 +110,8 @@ class EmailClient:
         
         try:
             self.send_and_print(self.s, f"EHLO client.{self.domain}")
-            server_response = self.read_multiline(self.s)
+            server_response = self.read_response(self.s)
+            self.pipelining = "250-PIPELINING" in server_response
             if "250-AUTH LOGIN PLAIN" not in server_response:
                 print("Server does not support AUTH LOGIN.")
                 self.s.close()
@@ -93,7 +126,7 @@ class EmailClient:
                 self.s = None
                 return False
 
-            encoded_user = base64.b64encode(self.username.encode()).decode()
+            encoded_user = base64.b64encode(self.login_name().encode()).decode()
             self.send_and_print(self.s, encoded_user)
 
             password_prompt = self.read_response(self.s).strip()
@@ -107,7 +140,7 @@ class EmailClient:
             self.send_and_print(self.s, encoded_pass)
 
             auth_response = self.read_response(self.s).strip()
-            print(f"Server: {auth_response}") if self.debug_mode else ""
+            log.debug("Server: %s", auth_response)
 
             if auth_response.startswith("235"):
                 return True
@@ -126,28 +159,47 @@ class EmailClient:
         :return: True if login is successful, False otherwise.
         """
         user_input = input("Enter email: ").strip()
-        if "@" in user_input:
-            self.username, self.domain = user_input.split("@", 1)
-            addr = dns.dns.dns_lookup(self.dns_ip, 8080, self.domain)
-            if addr:
-                addr = addr.split(" ")
-                self.smtp_ip, self.smtp_port = addr[0], int(addr[1])
-                print(f"DNS lookup found server on port {self.smtp_port}") if self.debug_mode else ""
-                self.pop_ip = self.smtp_ip
-            else:
-                return False
-        else:
+        if "@" not in user_input:
             return False
-        
         password = input("Enter password: ").strip()
+        return self.authenticate(user_input, password)
+
+    def authenticate(self, address, password):
+        """Logs in to the email server without prompting, for use from scripts.
+
+        Looks the account's domain up in the DNS and checks the credentials with the first of its servers that answers.
+        The servers found are kept in self.endpoints for later sessions.
+
+        :param address: The account's email address.
+        :param password: The account's password.
+        :return: True if login is successful, False otherwise.
+        """
+        if "@" not in address:
+            return False
+        self.username, self.domain = address.split("@", 1)
+        endpoints = dns.dns.dns_resolve(self.dns_ip, 8080, self.domain)
+        if not endpoints:
+            return False
+        self.endpoints = endpoints
         self.password_hash = self.hash_password(password)
 
+        for addr in endpoints: # fail over to the domain's other servers until one answers
+            self.smtp_ip, self.smtp_port = addr
+            log.debug("DNS lookup found server on port %s", self.smtp_port)
+            self.pop_ip = self.smtp_ip
+            self.s = self.connect()
+            if self.s is not None:
+                break
+            dns.dns.dns_report_failure(self.domain, addr)
+
         if self.server_auth():
             self.send_and_print(self.s, "QUIT") 
             self.read_response(self.s)  
             self.s.close()
             self.s = None
             return True
+        dns.dns.dns_invalidate(self.domain) # don't keep using a cached address that may be stale
+        return False
 
 
 
@@ -163,25 +215,23 @@ class EmailClient:
         :param forward: Whether to forward the email or not.
         :param domain: Domain of the server to forward to when forwarding.
 
-        :return: Returns if email is sent unsuccessfully.
+        :return: True if the server accepted the email, None otherwise.
         """
+        if forward:
+            if not self.relay_login(dst_addr, domain, self_username, pw):
+                return None
+            try:
+                accepted = self.send_message(f"{username}@{self.domain}", to_addr, msg)
+            except OSError as e:
+                print("Error sending email:", e)
+                accepted = False
+            self.quit()
+            return True if accepted else None
+
         try:
-            if forward:
-                self.domain = domain
-                self.username = self_username
-                self.password_hash = pw
-                try:
-                    self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.s.connect(dst_addr)
-                    greeting = self.read_response(self.s)
-                    print(f"Server: {greeting.strip()}") if self.debug_mode else ""
-                except Exception as e:
-                    print(f"Connection failed: {e}")
-                    return None
-                
             if self.server_auth():
-                from_address = f"{str(self.username if not forward else username)}@{self.domain}"
-                to_address = str(to_addr if forward else input("To (recipient email): ").strip())
+                from_address = f"{self.username}@{self.domain}"
+                to_address = input("To (recipient email): ").strip()
                 if "@" not in to_address:
                     print("Invalid recipient address.")
                     return
@@ -189,80 +239,286 @@ class EmailClient:
                 # MAIL FROM
                 self.send_and_print(self.s, f"MAIL FROM:{from_address}")
                 response = self.read_response(self.s).strip()
-                print(response) if self.debug_mode else ""
+                log.debug("%s", response)
                 if not response.startswith("250"):
                     return
 
                 # RCPT TO
                 self.send_and_print(self.s, f"RCPT TO:{to_address}")
                 response = self.read_response(self.s).strip()
-                print(response) if self.debug_mode else ""
+                log.debug("%s", response)
                 if not response.startswith("250"):
                     return
 
                 # DATA
                 self.send_and_print(self.s, "DATA")
                 response = self.read_response(self.s).strip()
-                print(response) if self.debug_mode else ""
+                log.debug("%s", response)
                 if not response.startswith("354"):
                     print("Server not ready for data.")
                     return
 
-                if not forward:
-                    # Compose message
-                    subject = input("Subject: ")
-                    print("Compose your email (end with ESC then Enter):")
-                    body = prompt("", multiline=True)
+                # Compose message
+                subject = input("Subject: ")
+                print("Compose your email (end with ESC then Enter):")
+                body = prompt("", multiline=True)
 
-                message = str(msg if forward else f"Subject: {subject}\r\n\r\n{body}\r\n.\r\n")
-                self.s.sendall(message.encode())
-                print(self.read_response(self.s).strip())
+                self.s.sendall(format_message(subject, body).encode())
+                response = self.read_response(self.s).strip()
+                print(response)
 
-                self.send_and_print(self.s, "QUIT")
-                self.read_response(self.s)
+                self.quit()
+                return True if response.startswith("250") else None
 
         except Exception as e:
             print("Error sending email:", e)
 
+    def send_many(self, messages, sessions = BULK_SESSIONS, on_result = None):
+        """ Sends many messages from the logged in account without any prompts.
+
+        The messages are shared out among up to sessions concurrent SMTP sessions. Each session authenticates once when
+        it is opened and then carries message after message, failing over to the domain's other servers if one stops
+        answering. A message that fails is retried once on a fresh session before it is reported as failed.
+        Must be called after authenticate or login.
+
+        :param messages: The messages to send, each a dict with "to", and optionally "subject" and "body".
+        :param sessions: The maximum number of sessions open at once.
+        :param on_result: Called with the result of each message as soon as it is known, from the sending thread.
+        :return: A dict with the number of messages "sent" and "failed", the "seconds" taken, the "rate" in messages
+            per second, and the "results" of each message in order: a dict with its "index", "to", whether it was
+            accepted ("ok"), the "error" if it was not, and the "seconds" it took.
+        """
+        messages = list(messages)
+        results = [None] * len(messages)
+        pending = iter(range(len(messages)))
+        lock = threading.Lock()
+
+        def work():
+            session = None
+            while True:
+                with lock:
+                    index = next(pending, None)
+                if index is None:
+                    break
+                message = messages[index]
+                started = time.monotonic()
+                error = None
+                if not isinstance(message, dict):
+                    error = "not a JSON object"
+                elif not isinstance(message.get("to"), str) or "@" not in message["to"]:
+                    error = "invalid recipient address"
+                elif not isinstance(message.get("subject", ""), str) or not isinstance(message.get("body", ""), str):
+                    error = "subject and body must be strings"
+                else:
+                    wire = format_message(message.get("subject", ""), message.get("body", ""))
+                    for attempt in range(2):
+                        if session is None:
+                            session = self.open_session()
+                            if session is None:
+                                error = f"could not open a session with {self.domain}"
+                                break
+                        try:
+                            if session.send_message(f"{self.username}@{self.domain}", message["to"], wire):
+                                error = None
+                                break
+                            error = "the server did not accept the message"
+                        except OSError as e:
+                            error = str(e)
+                        session.close() # the session may be broken; retry on a fresh one
+                        session = None
+                to = message.get("to", "") if isinstance(message, dict) else ""
+                results[index] = {"index": index, "to": to, "ok": error is None, "error": error,
+                                  "seconds": time.monotonic() - started}
+                if on_result is not None:
+                    on_result(results[index])
+            if session is not None:
+                session.quit()
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(max(1, min(sessions, len(messages))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.monotonic() - started
+        sent = sum(result["ok"] for result in results)
+        return {"sent": sent, "failed": len(results) - sent, "seconds": seconds,
+                "rate": len(results) / seconds if seconds else 0.0, "results": results}
+
+    def open_session(self):
+        """ Opens another authenticated SMTP session for the logged in account.
+
+        :return: An EmailClient holding the session, or None if none of the domain's servers accepted it.
+        """
+        for addr in self.endpoints:
+            session = EmailClient(dns_ip=self.dns_ip, debug_mode=self.debug_mode, timeout=self.timeout, pop_port=self.pop_port)
+            if session.relay_login(addr, self.domain, self.username, self.password_hash):
+                return session
+            dns.dns.dns_report_failure(self.domain, addr)
+        return None
+
+    def login_name(self):
+        """ The name to log in to a server with: the full address of the account, since a server may host several
+        domains and only takes a bare username as one of its own primary domain's.
+
+        :return: username@domain, or the username as it is if it already names its domain.
+        """
+        return self.username if "@" in self.username else f"{self.username}@{self.domain}"
+
+    def relay_login(self, dst_addr, domain, username, pw):
+        """ Opens an authenticated session with another server, for relaying mail to it.
+
+        :param dst_addr: Address of the server to connect to.
+        :param domain: Domain of the relaying server.
+        :param username: Username the relaying server authenticates as, qualified with domain unless it is a full
+            address already.
+        :param pw: Password the relaying server authenticates with.
+        :return: True if the session is open and authenticated, False otherwise.
+        """
+        self.domain = domain
+        self.username = username
+        self.password_hash = pw
+        try:
+            self.s, greeting = self.open_socket(dst_addr)
+            log.debug("Server: %s", greeting.strip())
+        except Exception as e:
+            log.warning("Connection failed: %s", e)
+            self.close()
+            return False
+        if self.server_auth():
+            return True
+        self.close()
+        return False
+
+    def send_message(self, from_address, to_address, msg):
+        """ Sends one message over the open, authenticated session, leaving the session open for the next one.
+
+        :param from_address: Email address of the sender.
+        :param to_address: Email address of the recipient, or a list of addresses to send the message to in one
+            transaction.
+        :param msg: The message, including its terminating ".", as a string or a binary file sent from its start.
+        :return: True if the server accepted the message for every recipient, False otherwise.
+        """
+        recipients = [to_address] if isinstance(to_address, str) else to_address
+        commands = [(f"MAIL FROM:{from_address}", "250")] + [(f"RCPT TO:{rcpt}", "250") for rcpt in recipients] + [("DATA", "354")]
+        if self.pipelining:
+            # one round trip for the whole envelope
+            self.send_and_print(self.s, "\r\n".join(command for command, _ in commands))
+            responses = self.read_replies(self.s, len(commands))
+        else:
+            responses = []
+            for command, expected in commands:
+                self.send_and_print(self.s, command)
+                responses.append(self.read_response(self.s).strip())
+                if not responses[-1].startswith(expected):
+                    break
+        for (_, expected), response in zip(commands, responses):
+            log.debug("%s", response)
+            if not response.startswith(expected):
+                return False
+        if len(responses) < len(commands):
+            return False
+        if isinstance(msg, str):
+            self.s.sendall(msg.encode())
+        else:
+            self.s.sendfile(msg, 0) # from the start, so a retry over another session sends all of it
+        response = self.read_response(self.s).strip()
+        log.debug("%s", response)
+        return response.startswith("250")
+
+    def quit(self):
+        """ Ends the session with the server and closes the connection. """
+        try:
+            self.send_and_print(self.s, "QUIT")
+            self.read_response(self.s)
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        """ Closes the connection to the server, if there is one. """
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+
     def connect(self):
         """Connects to the email server.
         
         :return s: Returns the socket object if connection is successful, None otherwise.
         """
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            print(f"trying to connect to: {self.smtp_ip}, {self.smtp_port}") if self.debug_mode else ""
-            s.connect((self.smtp_ip, self.smtp_port))
-            greeting = self.read_response(s)
-            print(f"Server: {greeting.strip()}") if self.debug_mode else ""
+            log.debug("trying to connect to: %s, %s", self.smtp_ip, self.smtp_port)
+            s, greeting = self.open_socket((self.smtp_ip, self.smtp_port))
+            log.debug("Server: %s", greeting.strip())
             return s
         except Exception as e:
-            print(f"Connection failed: {e}")
+            log.warning("Connection failed: %s", e)
             return None
 
+    def open_socket(self, addr):
+        """ Opens a TCP connection to a server and reads its greeting, giving up after CONNECT_TIMEOUT seconds if it
+        does not answer, so that the next server can be tried.
+
+        :param addr: The (ip, port) of the server.
+        :return: The connected socket, with the client's timeout set, and the greeting.
+        """
+        s = socket.create_connection(addr, timeout=CONNECT_TIMEOUT)
+        try:
+            greeting = self.read_response(s)
+        except Exception:
+            s.close()
+            raise
+        s.settimeout(self.timeout)
+        return s, greeting
+
+    def reader(self, sock):
+        """ Gets the buffered reader of a socket, creating it on first use.
+
+        :param sock: The socket object to read from.
+        :return: The LineReader of the socket.
+        """
+        reader = self.readers.get(sock)
+        if reader is None:
+            reader = self.readers[sock] = LineReader(sock)
+        return reader
+
     def read_response(self, sock):
         """ Reads a response from the server.
 
         :param sock: The socket object to read from.
-        :return: The decoded response from the server.
+        :return: The decoded response from the server, including every line of a multiline SMTP reply, or "" if the
+            server closed the connection.
         """
-        return sock.recv(1024).decode()
+        try:
+            return self.reader(sock).read_reply().decode(errors="replace")
+        except ConnectionError:
+            return ""
 
-    def read_multiline(self, sock):
-        """ Reads a multiline response from the server.
+    def read_replies(self, sock, count):
+        """ Reads the replies to several pipelined commands.
 
         :param sock: The socket object to read from.
-        :return: The decoded response from the server.
+        :param count: The number of replies to read.
+        :return: The list of decoded replies, fewer than count if the server closed the connection.
         """
-        lines = []
-        while True:
-            chunk = sock.recv(1024).decode()
-            lines.append(chunk)
-            if "250 Ok" in chunk or "\n.\r\n" in chunk:
-                break
-        return "".join(lines)
+        replies = []
+        while len(replies) < count and (reply := self.read_response(sock).strip()):
+            replies.append(reply)
+        return replies
 
+    def read_multiline(self, sock):
+        """ Reads a multiline POP3 response from the server, undoing the dot-stuffing of its body.
 
+        :param sock: The socket object to read from.
+        :return: The decoded status line, followed by the body if the status is +OK.
+        """
+        try:
+            reader = self.reader(sock)
+            status = reader.read_line()
+            body = reader.read_block() if status.startswith(b"+OK") else b""
+        except ConnectionError:
+            return ""
+        return (status + b"\r\n" + body).decode(errors="replace")
 
     def send_and_print(self, sock, msg):
         """ Sends a message to the server and prints the message if in debug mode.
@@ -271,8 +527,7 @@ class EmailClient:
         :param msg: The message to send.
         """
         sock.sendall((msg + "\r\n").encode())
-        if self.debug_mode:
-            print(f"> {msg}")
+        log.debug("> %s", msg)
 
     def hash_password(self, password):
         """ Hashes the password using SHA256.
@@ -296,7 +551,7 @@ class EmailClient:
 
             self.send_and_print(self.pop_socket, "STAT")
             stat = self.read_response(self.pop_socket)
-            print(f"Server: {stat.strip()}") if self.debug_mode else ""
+            log.debug("Server: %s", stat.strip())
             count = int(stat.split()[1]) if stat.startswith("+OK") else -1
 
             if count == 0:
@@ -304,6 +559,7 @@ class EmailClient:
             elif count == -1:
                 print(f"Error fetching inbox: {stat}")
                 return
+            self.sync_cache()
             self.pop3_trans(count)
 
         except Exception as e:
@@ -317,26 +573,24 @@ class EmailClient:
         :return: Returns true if authentification is successful, false otherwise.
         """
         try:
-            self.pop_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.pop_socket.connect((self.pop_ip, self.pop_port))
-            ready = self.read_response(self.pop_socket)
-            print(f"Server: {ready.strip()}") if self.debug_mode else ""
+            self.pop_socket, ready = self.open_socket((self.pop_ip, self.pop_port))
+            log.debug("Server: %s", ready.strip())
             if not ready.startswith("+OK"):
                 print("POP3 server not ready.")
                 self.pop_socket.close()
                 return False
 
-            self.send_and_print(self.pop_socket, "USER " + self.username)
+            self.send_and_print(self.pop_socket, "USER " + self.login_name())
             user_response = self.read_response(self.pop_socket)
-            print(f"Server: {user_response.strip()}") if self.debug_mode else ""
-            if not user_response.startswith(f"+OK {self.username}"):
+            log.debug("Server: %s", user_response.strip())
+            if not user_response.startswith(f"+OK {self.login_name()}"):
                 print("Error with username.")
                 self.pop_socket.close()
                 return False
 
             self.send_and_print(self.pop_socket, "PASS " + self.password_hash)
             pass_response = self.read_response(self.pop_socket)
-            print(f"Server: {pass_response.strip()}") if self.debug_mode else ""
+            log.debug("Server: %s", pass_response.strip())
             if not pass_response.startswith(f"+OK {self.username}"):
                 print("Error with password.")
                 self.pop_socket.close()
@@ -348,6 +602,73 @@ class EmailClient:
             print(f"POP3 error: {e}")
             return False
     
+    def sync_cache(self):
+        """ Brings the offline message cache up to date with the server.
+
+        One UIDL gives the unique id of every message on the server. Cached messages whose ids are gone are dropped,
+        and the headers of messages not seen before are fetched with pipelined TOP n 0 commands, so each sync only
+        downloads what is new.
+        """
+        if self.cache is None:
+            self.cache = MessageCache.for_account(self.cache_dir, self.username, self.domain)
+        listing = self.pop3_pipeline(["UIDL"])[0].split("\r\n")[1:]
+        self.uids = {int(num): uid for num, uid in (line.split() for line in listing if line[:1].isdigit())}
+        self.deleted = set()
+        dropped = self.cache.retain(self.uids.values())
+        cached = self.cache.uids()
+        new = [num for num, uid in self.uids.items() if uid not in cached]
+        responses = self.pop3_pipeline([f"TOP {num} 0" for num in new])
+        self.cache.add_headers({self.uids[num]: raw for num, raw in zip(new, responses) if self.isStatusOK(raw)})
+        log.debug("Cache: %s new, %s removed, %s already cached", len(new), dropped, len(self.uids) - len(new))
+
+    def retrieve(self, num):
+        """ Gets a message, from the offline cache if it has been downloaded before and from the server otherwise.
+
+        :param num: The message number.
+        :return: The RETR response holding the message, or the server's error response.
+        """
+        uid = self.uids.get(num) if num not in self.deleted else None
+        cached = self.cache.message(uid) if uid is not None else None
+        if cached is not None:
+            return cached
+        response = self.pop3_pipeline([f"RETR {num}"])[0]
+        if uid is not None and self.isStatusOK(response):
+            self.cache.add_message(uid, response)
+        return response
+
+    def pop3_pipeline(self, commands, window = None):
+        """ Sends POP3 commands back to back and collects their responses in order.
+
+        Up to window commands are in flight at once, so fetching many messages costs one round trip per window
+        rather than one per message. Must only be used once the session is authenticated.
+
+        :param commands: The commands to send, e.g. "RETR 3", "TOP 4 0" or "DELE 5".
+        :param window: The maximum number of commands awaiting a response. Defaults to the client's pop_window.
+        :return: The responses, one per command, each including the unstuffed body of a multiline response.
+        """
+        window = max(1, window or self.pop_window)
+        responses = []
+        sent = 0
+        while len(responses) < len(commands):
+            if sent < len(commands) and sent - len(responses) < window:
+                batch = commands[sent:len(responses) + window]
+                for command in batch:
+                    log.debug("> %s", command)
+                self.pop_socket.sendall("".join(f"{command}\r\n" for command in batch).encode())
+                sent += len(batch)
+            command = commands[len(responses)].split()
+            multiline = command[0].upper() in ("RETR", "TOP") or (command[0].upper() in ("LIST", "UIDL") and len(command) == 1)
+            responses.append(self.read_pop_response(multiline))
+        return responses
+
+    def read_pop_response(self, multiline):
+        """ Reads one POP3 response. Anything received after it stays buffered for the next one.
+
+        :param multiline: Whether a successful response continues until a line holding only ".".
+        :return: The decoded response.
+        """
+        return self.read_multiline(self.pop_socket) if multiline else self.read_response(self.pop_socket)
+
     def pop3_trans(self, total_msgs):
         """ POP3 Transaction function for client side.
 
@@ -365,9 +686,12 @@ class EmailClient:
             end_msg = min(start_msg + page_size - 1, total_msgs)
             print(f"\nShowing messages {start_msg} to {end_msg} of {total_msgs}:\n")
 
+            # the headers of every message were cached by sync_cache, so listing a page needs no round trip
             for i in range(start_msg, end_msg + 1):
-                self.send_and_print(self.pop_socket, f"RETR {i}")
-                raw = self.read_multiline(self.pop_socket)
+                raw = self.cache.headers(self.uids[i]) if i in self.uids and i not in self.deleted else None
+                if raw is None:
+                    print(f"{i}. (marked for deletion)")
+                    continue
                 from_line = next((line for line in raw.split("\r\n") if line.startswith("From:")), "From: ???")
                 subject_line = next((line for line in raw.split("\r\n") if line.startswith("Subject:")), "Subject: ???")
                 print(f"{i}. {from_line} | {subject_line}")
@@ -395,32 +719,30 @@ class EmailClient:
                     print("You're on the first page.")
             elif action == "v":
                 msg = input("Message number to view: ").strip()
-                self.send_and_print(self.pop_socket, f"RETR {msg}")
-                response = self.read_multiline(self.pop_socket)
+                response = self.retrieve(int(msg)) if msg.isdigit() else self.pop3_pipeline([f"RETR {msg}"])[0]
                 if not self.isStatusOK(response):
                     self.pop_socket.close()
                     break
                 print(response)
             elif action == "d":
                 msg = input("Message number to delete: ").strip()
-                self.send_and_print(self.pop_socket, f"DELE {msg}")
-                response = self.read_response(self.pop_socket).strip()
+                response = self.pop3_pipeline([f"DELE {msg}"])[0].strip()
                 if not self.isStatusOK(response):
                     self.pop_socket.close()
                     break
+                self.deleted.add(int(msg))
                 print(f"Email {msg} marked for deletion.")
-                print(response) if self.debug_mode else ""
+                log.debug("%s", response)
             elif action == "r":
-                self.send_and_print(self.pop_socket, "RSET")
-                response = self.read_response(self.pop_socket).strip()
+                response = self.pop3_pipeline(["RSET"])[0].strip()
                 if not self.isStatusOK(response):
                     self.pop_socket.close()
                     break
+                self.deleted = set()
                 print("All emails unmarked from deletion for this session.")
-                print(response) if self.debug_mode else ""
+                log.debug("%s", response)
             elif action == "q":
-                self.send_and_print(self.pop_socket, "QUIT")
-                print(self.read_response(self.pop_socket).strip())
+                print(self.pop3_pipeline(["QUIT"])[0].strip())
                 self.pop_socket.close()
                 break
             else:
@@ -434,15 +756,85 @@ class EmailClient:
         return msg.startswith("+OK") 
 
 
+def format_message(subject, body):
+    """ Builds the DATA of a message.
+
+    Lines end in CRLF and a "." is doubled at the start of any line, so no body line can end the DATA early.
+
+    :param subject: The subject of the message.
+    :param body: The body of the message.
+    :return: The message, including its terminating ".".
+    """
+    body = "\r\n".join("." + line if line.startswith(".") else line for line in body.splitlines())
+    return f"Subject: {subject}\r\n\r\n{body}\r\n.\r\n"
+
+def bulk(client, args):
+    """ Sends every message in a JSON lines file, printing the outcome of each and the overall throughput.
+
+    :param client: The EmailClient to send with.
+    :param args: The parsed command line arguments.
+    :return: The exit status: 0 if every message was sent, 1 otherwise.
+    """
+    messages, skipped = [], 0
+    with open(args.input, "r") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"{args.input}:{number}: skipped, not valid JSON ({e.msg})")
+                skipped += 1
+                continue
+            if not isinstance(message, dict):
+                print(f"{args.input}:{number}: skipped, not a JSON object")
+                skipped += 1
+                continue
+            messages.append(message)
+    if not messages:
+        print("No messages to send.")
+        return 1
+    address = args.user or input("Enter email: ").strip()
+    password = os.environ.get(PASSWORD_ENV)
+    if password is None:
+        password = getpass.getpass("Enter password: ")
+    if not client.authenticate(address, password):
+        print("Login failed.")
+        return 1
+
+    def report(result):
+        status = "sent" if result["ok"] else f"FAILED ({result["error"]})"
+        print(f"{result["index"] + 1}/{len(messages)} {result["to"]}: {status} in {result["seconds"] * 1000:.1f} ms")
+
+    summary = client.send_many(messages, sessions=args.sessions, on_result=report)
+    print(f"Sent {summary["sent"]} of {len(messages)} messages in {summary["seconds"]:.2f} s "
+          f"({summary["rate"]:.1f} messages/s), {summary["failed"]} failed, {skipped} lines skipped")
+    return 0 if summary["failed"] == 0 and skipped == 0 else 1
+
 def main():
     parser = argparse.ArgumentParser(description="For running a SMTP/POP3 Client")
 
+    parser.add_argument("mode", nargs="?", choices=["interactive", "bulk"], default="interactive", help="Run the interactive client, or send the messages in --input and exit (default: interactive)")
+    parser.add_argument("--input", type=str, help="For bulk mode, a JSON lines file of messages, each an object with \"to\", \"subject\" and \"body\"")
+    parser.add_argument("--user", "-u", type=str, help=f"For bulk mode, the email address to send from (prompted for if omitted). The password is read from ${PASSWORD_ENV}, or prompted for")
+    parser.add_argument("--sessions", "-n", type=int, default=BULK_SESSIONS, help=f"For bulk mode, the number of concurrent SMTP sessions (default: {BULK_SESSIONS})")
+
     parser.add_argument("--debug", "-d", action="store_true", help="Enable debug mode (default: False)")
     parser.add_argument("--dns-ip", "-i", type=str, default="127.0.0.1", help="DNS server IP address (default: 127.0.0.1)")
+    parser.add_argument("--cache-dir", "-c", type=str, default=CACHE_DIR, help=f"Directory to keep the offline message cache in (default: {CACHE_DIR})")
+    parser.add_argument("--no-cache", action="store_true", help="Keep downloaded messages in memory only, for this run")
+    parser.add_argument("--pop-port", type=int, default=POP3_PORT, help=f"Port the servers accept POP3 connections on, as set with the server's --pop-port (default: {POP3_PORT})")
+    parser.add_argument("--window", "-w", type=int, default=POP_WINDOW, help=f"Number of POP3 commands to send ahead of their responses when reading the inbox (default: {POP_WINDOW})")
 
+    logconfig.add_arguments(parser)
     args = parser.parse_args()
+    logconfig.setup_from(args)
+    if args.mode == "bulk" and not args.input:
+        parser.error("bulk mode needs --input")
     
-    client = EmailClient(dns_ip=args.dns_ip, debug_mode=args.debug)
+    client = EmailClient(dns_ip=args.dns_ip, debug_mode=args.debug, pop_window=args.window, cache_dir=None if args.no_cache else args.cache_dir, pop_port=args.pop_port)
+    if args.mode == "bulk":
+        raise SystemExit(bulk(client, args))
     client.run()
 
 
@@ -4,15 +4,63 @@ Authors: Caleb Naeger - cmn4315@rit.edu, Landon Spitzer - lbs9440@rit.edu
 """
 from enum import Enum
 import argparse
+import os
+import signal
 import socket
 import json
 import select
 import base64
 import random
+import tempfile
+import time
 import dns.dns
-import smtp_client
+import aio_engine
+import logconfig
+import metrics
+from mailstore import MailStore, MailboxCache, Maildrop
+from relay import RelayQueue
 
 SERVER_PASSWORD = 'pass'
+POP3_PORT = 8110
+MAX_MESSAGE_BYTES = 32 * 1024 * 1024
+MAX_RECIPIENTS = 100 # per transaction, as RFC 5321 requires servers to accept at least
+SPILL_BYTES = 1024 * 1024
+RECV_BYTES = 64 * 1024 # read per recv call, so a large message takes few select wakeups
+FLUSH_TIMEOUT = 30 # longest a stopping server waits for queued mailbox writes, in seconds
+
+log = logconfig.get("server")
+smtp_log = logconfig.get("smtp")
+pop_log = logconfig.get("pop3")
+wire_log = logconfig.get(logconfig.WIRE)
+
+command_seconds = metrics.registry.histogram("mail_command_seconds", "Time taken to handle each command.", ("protocol", "command"))
+connections = metrics.registry.gauge("mail_connections", "Open client connections, by protocol and state.", ("protocol", "state"))
+accepted = metrics.registry.counter("mail_connections_accepted", "Client connections accepted.", ("protocol",))
+received_bytes = metrics.registry.counter("mail_received_bytes", "Bytes received from clients.", ("protocol",))
+sent_bytes = metrics.registry.counter("mail_sent_bytes", "Bytes of replies sent to clients.", ("protocol",))
+messages = metrics.registry.counter("mail_messages", "Messages received over SMTP, by what became of them: delivered to a local mailbox, queued for relaying, refused as too large, or failed to be stored.", ("outcome",))
+
+def open_listeners(port, pop_port = POP3_PORT, reuse_port = False, listen = True):
+    """Open the SMTP and POP3 listening sockets.
+
+    :param port: the port to accept SMTP connections on.
+    :param pop_port: the port to accept POP3 connections on.
+    :param reuse_port: whether to set SO_REUSEPORT, so that several worker processes can each bind the same ports.
+    :param listen: whether to start listening, or only reserve the ports.
+    :return: the SMTP and POP3 sockets.
+    """
+    socks = []
+    for p in (port, pop_port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(False)
+        sock.bind(('0.0.0.0', p))
+        if listen:
+            sock.listen(128)
+        socks.append(sock)
+    return socks[0], socks[1]
 
 class States(Enum):
     INIT = "INIT"
@@ -23,52 +71,143 @@ class States(Enum):
     AUTH_USER = "AUTH_USER"
     AUTH_PW = "AUTH_PW"
     DATA = "DATA"
+    BODY = "BODY"
     POP3_TRAN = "POP3_TRANSACTION"
 
+# verb lookup tables: the uppercased first token of a command line -> the name of its command
+SMTP_VERBS = {b"EHLO": "EHLO", b"HELO": "EHLO", b"AUTH": "AUTH LOGIN", b"MAIL": "MAIL FROM", b"RCPT": "RCPT TO",
+              b"DATA": "DATA", b"RSET": "RSET", b"QUIT": "QUIT"}
+POP3_VERBS = {verb.encode(): verb for verb in ("USER", "PASS", "STAT", "LIST", "RETR", "TOP", "UIDL", "DELE", "NOOP", "RSET", "QUIT")}
+
+def parse_lines(lines, verbs, unknown):
+    """Lazily split command lines into commands and their arguments, looking each verb up in a table.
+
+    :param lines: the received lines, without their line endings.
+    :param verbs: the verb lookup table, SMTP_VERBS or POP3_VERBS.
+    :param unknown: the command name given to lines whose verb is not in the table.
+    :return: a generator of (command, args) tuples, where args is the rest of the line after the verb, or the whole
+        line when the verb is unknown, since it may be data such as a base64 credential.
+    """
+    for line in lines:
+        verb, _, args = line.partition(b" ")
+        command = verbs.get(verb.upper())
+        yield (command, args) if command is not None else (unknown, line)
+
+class HostedDomain:
+    """One of the email domains a Server hosts, with its own accounts, mailbox storage and outbound relay queue, all
+    kept in the domain's data directory.
+    """
+    def __init__(self, name, dns_ip, dns_port, cache_bytes):
+        """Constructor for the HostedDomain class.
+
+        :param name: the domain, e.g. "abeersclass.com". Its data directory is named after its first label.
+        :param dns_ip: the IP of the DNS server, for relaying mail to other domains.
+        :param dns_port: the port of the DNS server.
+        :param cache_bytes: the memory cap of the domain's mailbox cache, in bytes.
+        """
+        self.name = name
+        self.data_dir = name.split(".")[0]
+        with open(f"{self.data_dir}/accounts.json") as f:
+            self.accounts = json.load(f)
+        self.store = MailStore(self.data_dir)
+        self.store.migrate_json(f"{self.data_dir}/emails.json")
+        self.mailboxes = MailboxCache(self.store, cache_bytes)
+        self.relay = RelayQueue(f"{self.data_dir}/spool", name, SERVER_PASSWORD, dns_ip, dns_port, bounce=self.bounce)
+
+    def bounce(self, entry, error):
+        """Tell the sender of a message that could not be relayed that it was not delivered.
+
+        :param entry: the relay spool entry of the message.
+        :param error: the reason the last relay attempt failed.
+        """
+
+        username, _, domain = entry["from"].partition("@")
+        if domain not in ("", self.name):
+            return
+        rcpts = ", ".join(entry["to"])
+        msg = f"Subject: Undeliverable: mail to {rcpts}\r\n\r\nYour message to {rcpts} could not be delivered after {entry["attempts"]} attempts.\r\nLast error: {error}\r\n.\r\n"
+        self.mailboxes.deliver(username, f"postmaster@{self.name}", msg)
+
 class Server:
-    def __init__(self, domain = "abeersclass.com", dns_ip = "127.0.0.1") -> None:
+    def __init__(self, domain = "abeersclass.com", dns_ip = "127.0.0.1", cache_bytes = 64 * 1024 * 1024, listeners = None, max_message_bytes = MAX_MESSAGE_BYTES, spill_bytes = SPILL_BYTES, domains = (), pop_port = POP3_PORT) -> None:
         """Constructor for email Server class.
 
-        :param domain: the email domain for which this server should operate.
+        :param domain: the email domain for which this server should operate. Users of this domain can log in without
+            giving their domain.
         :param dns_ip: the IP of the DNS server.
+        :param cache_bytes: the memory cap of the in-memory mailbox cache, in bytes, shared evenly between the domains.
+        :param listeners: the SMTP and POP3 listening sockets to serve, if they were opened by a supervisor. When
+            omitted, the server opens its own on a random SMTP port and registers it with the DNS for every domain it
+            hosts, renewing the registrations' leases for as long as it runs.
+        :param max_message_bytes: the largest message accepted with DATA, in bytes. Larger ones are refused with 552.
+        :param spill_bytes: the size above which a message being received is moved from memory to a temporary file.
+        :param domains: further domains to host alongside domain, on the same listeners. Their users log in as
+            user@domain, and mail between hosted domains is delivered in-process, without relaying.
+        :param pop_port: the port to accept POP3 connections on, when the server opens its own listeners.
         """
         self.clients = {}
         self.domain = domain
-        self.load_accounts(f"{self.domain.split(".")[0]}/accounts.json")
-        port = random.randint(5000, 8000)
-        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_sock.setblocking(False)
-        self.server_sock.bind(('0.0.0.0', port))
-        self.server_sock.listen(5)
-        print(f"Server socket bound to port {port}")
-        dns.dns.dns_update(dns_ip, 8080, domain, port)
-        self.pop_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.pop_sock.setblocking(False)
-        self.pop_sock.bind(('0.0.0.0', 8110))
-        self.pop_sock.listen(5)
-        self.inputs = [self.server_sock, self.pop_sock]
         self.dns_port = 8080
         self.dns_ip = dns_ip
-
-    def load_accounts(self, filename: str):
-        """Load known accounts from a json file
-
-        :param filename: the path of the accounts json file
+        names = list(dict.fromkeys([domain, *domains]))
+        self.hosted = {name: HostedDomain(name, dns_ip, self.dns_port, cache_bytes // len(names)) for name in names} # domain -> HostedDomain
+        primary = self.hosted[domain] # its accounts, storage and relay queue stay reachable directly on the server
+        self.data_dir = primary.data_dir
+        self.accounts = primary.accounts
+        self.store = primary.store
+        self.mailboxes = primary.mailboxes
+        self.relay = primary.relay
+        self.heartbeats = []
+        if listeners is None:
+            port = random.randint(5000, 8000)
+            listeners = open_listeners(port, pop_port)
+            log.info("Server socket bound to port %d", port)
+            self.heartbeats = [dns.dns.dns_heartbeat(dns_ip, self.dns_port, name, port) for name in self.hosted]
+        self.server_sock, self.pop_sock = listeners
+        self.listeners = {self.server_sock, self.pop_sock}
+        self.inputs = {self.server_sock, self.pop_sock}
+        self.outputs = set() # clients with buffered replies waiting for their socket to become writable
+        self.loop = None # set by the asyncio engine while it is running
+        self.max_message_bytes = max_message_bytes
+        self.spill_bytes = spill_bytes
+        connections.track(self.connection_states)
+
+        # the handler of each command in each state, with a fallback for commands missing from the table
+        self.smtp_handlers = {
+            States.INIT: {"EHLO": self.smtp_ehlo},
+            States.AUTH_INIT: {"AUTH LOGIN": self.smtp_auth},
+            States.AUTH_USER: {},
+            States.AUTH_PW: {},
+            States.READY: {"MAIL FROM": self.smtp_mail, "RSET": self.smtp_rset},
+            States.DEST: {"RCPT TO": self.smtp_rcpt, "RSET": self.smtp_rset},
+            States.DATA: {"RCPT TO": self.smtp_rcpt, "DATA": self.smtp_data, "RSET": self.smtp_rset},
+        }
+        self.smtp_fallbacks = {States.AUTH_USER: self.smtp_username, States.AUTH_PW: self.smtp_password}
+        self.pop_handlers = {
+            States.AUTH_USER: {"USER": self.pop_user},
+            States.AUTH_PW: {"PASS": self.pop_pass},
+            States.POP3_TRAN: {"STAT": self.pop_stat, "LIST": self.pop_list, "RETR": self.pop_retr, "TOP": self.pop_top,
+                               "UIDL": self.pop_uidl, "DELE": self.pop_dele, "NOOP": self.pop_noop, "RSET": self.pop_rset},
+        }
+        self.pop_fallbacks = {States.POP3_TRAN: self.pop_noop}
+        for table in self.smtp_handlers.values():
+            table["QUIT"] = self.smtp_quit
+        for table in self.pop_handlers.values():
+            table["QUIT"] = self.pop_quit
+
+    def load_emails(self, client):
+        """Load the index entries of the emails saved in a logged in user's mailbox, through the mailbox cache
+
+        :param client: the entry from self.clients of the logged in client.
         """
-        with open(filename) as f:
-            data = json.load(f)
-            self.accounts = data
-
-    def load_emails(self, username):
-        """Load saved emails from the email "database" json file associated with this domain
+        return client["hosted"].mailboxes.get(client["username"])
 
-        :param username: the username for which to retrieve emails
+    def flush_mailboxes(self):
+        """Write out the queued mailbox changes of every hosted domain.
         """
-        with open(f"{self.domain.split(".")[0]}/emails.json", "r") as f:
-            emails = json.load(f)
-            if username not in emails:
-                emails[username] = []
-            return emails[username]
+        for hosted in self.hosted.values():
+            if not hosted.mailboxes.flush(FLUSH_TIMEOUT):
+                log.error("Gave up waiting for queued deletions in %s to reach the disk; those messages may reappear", hosted.name)
 
     def new_client(self, sock):
         """Accept a new client connection
@@ -76,16 +215,31 @@ class Server:
         :param sock: the server socket from which to accept the connection
         """
 
-        client, addr = sock.accept()
+        try:
+            client, addr = sock.accept()
+        except BlockingIOError:
+            return # another worker process sharing the listener accepted it first
         client.setblocking(False)
-        self.inputs.append(client)
-        self.clients[client] = {"addr": addr, "buffer": b"", "state": States.INIT, "dst": "", "from": b"", "msg": b"", "type": "SMTP", "to_delete":[], "username": ""} # track the address, current buffer, and state machine state for the client
-        if sock.getsockname()[1] == 8110:
+        self.inputs.add(client)
+        self.add_client(client, addr, sock is self.pop_sock)
+
+    def add_client(self, client, addr, pop):
+        """Start tracking a newly connected client and greet it
+
+        :param client: the client connection, a socket or any object providing send and close
+        :param addr: the address of the client
+        :param pop: whether the client connected to the POP3 listener
+        """
+
+        self.clients[client] = {"addr": addr, "buffer": b"", "out": bytearray(), "closing": False, "state": States.INIT, "dst": [], "from": b"", "msg": b"", "type": "SMTP", "username": "", "hosted": None, "maildrop": None, "waiting": False} # track the address, current buffer, output buffer, and state machine state for the client
+        accepted.inc("pop3" if pop else "smtp")
+        if pop:
             self.clients[client]["type"] = "POP3"
-            client.sendall((f'+OK pop3-server8110.{self.domain} POP3 server ready\r\n').encode())
+            self.send(client, (f'+OK pop3-server{self.pop_sock.getsockname()[1]}.{self.domain} POP3 server ready\r\n').encode())
             self.clients[client]['state'] = States.AUTH_USER
         else:
-            client.sendall(f"220 smtp-server{self.server_sock.getsockname()[1]}.abeeersclass.com".encode())
+            self.send(client, f"220 smtp-server{self.server_sock.getsockname()[1]}.abeeersclass.com\r\n".encode())
+        self.flush(client)
 
     def read_from_client(self, client):
         """Read a message from the client, responding to commands as needed
@@ -94,8 +248,12 @@ class Server:
         """
 
         try:
-            data = client.recv(1024)
+            data = client.recv(RECV_BYTES)
+            if not data:
+                self.disconnect(client)
+                return
             self.clients[client]["buffer"] += data
+            received_bytes.inc(self.clients[client]["type"].lower(), amount=len(data))
             if self.clients[client]["type"] == "SMTP":
                 self.smtp_commands(client)
             elif self.clients[client]["type"] == "POP3":
@@ -110,240 +268,383 @@ class Server:
         """
 
         client = self.clients[client_sock]
+        if client["waiting"]:
+            return
         input_lines = client['buffer'].split(b"\r\n")
         client['buffer'] = input_lines[-1] # write unfinished line back to the dict
         input_lines = input_lines[:-1]
 
-        print(f"received form client, input={input_lines}")
-        commands = self.parse_pop3_commands(input_lines)
-        user_emails = []
-        if client["state"] not in [States.AUTH_USER, States.AUTH_PW]:
-            user_emails = self.load_emails(client["username"])
-        for i, command in enumerate(commands):
-            line = input_lines[i]
-            match command:
-                case "USER":
-                    if client["state"] == States.AUTH_USER:
-                        client["username"] = line.decode()[5:]
-                        client_sock.sendall((f'+OK {client["username"]}\r\n').encode())
-                        client["state"] = States.AUTH_PW
-                case "PASS":
-                    if client["state"] == States.AUTH_PW:
-                        client["pw"] = line[5:].decode()
-                        if self.verify_account(client):
-                            user_emails = self.load_emails(client["username"])
-                            client_sock.sendall((f"+OK {client["username"]}'s maildrop has {len(user_emails)} messages ({sum(len(email["msg"]) for email in user_emails)} octets)\r\n").encode())
-                            client["state"] = States.POP3_TRAN
-                        else:
-                            client_sock.sendall(b'ERROR Authentication credentials invalid\r\n')
-                            client["state"] = States.AUTH_USER
-                    else:
-                        client_sock.sendall(b'ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "STAT":
-                    if client["state"] == States.POP3_TRAN:
-                        try:
-                            total_bytes = 0
-                            for email in user_emails:
-                                total_bytes += len(email['msg'])
-                            client_sock.sendall((f'+OK {len(user_emails)} {total_bytes}\r\n').encode())
-                        except AttributeError:
-                            client_sock.sendall("ERROR unable to display inbox stats".encode())
-                    else:
-                        client_sock.sendall(b'ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock) 
-                case "LIST":
-                    if client["state"] == States.POP3_TRAN:
-                        parts = line.decode().split()
-                        if len(parts) == 2 and parts[1].isnumeric():       
-                            num = int(parts[1])
-                            client_sock.sendall((f"+OK 1 {len(user_emails[num]["msg"])}\r\n").encode())
-                        else:
-                            total_bytes = 0
-                            for email in user_emails:
-                                total_bytes += len(email['msg'])
-                            
-                            final_str = f"+OK {len(user_emails)} messages ({total_bytes} octets)\r\n"
-
-                            for i, email in enumerate(user_emails):
-                                final_str += f"{i+1} {len(email)}\r\n"
-                            final_str += ".\r\n"
-                            client_sock.sendall(final_str.encode())
-                    else:
-                        client_sock.sendall(b'ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock) 
-                case "RETR":
-                    if client["state"] == States.POP3_TRAN:
-                        msg_num = line[5:].decode()
-                        print(f"In RETR, len(emails = {len(user_emails)}, msgnum = {msg_num})")
-                        if msg_num.isnumeric() and len(user_emails) >= int(msg_num) >= 1:
-                            msg_num = int(msg_num.strip())
-                            current_email = user_emails[msg_num-1]
-                            multiline_response = f"+OK {len(current_email["msg"])} octets\r\n".encode()
-                            multiline_response += f"From: {current_email["FROM"]}\r\n".encode()
-                            multiline_response += f"To: {client["username"]}@{self.domain}\r\n".encode()
-                            multiline_response += current_email["msg"].encode()
-                            client_sock.sendall(multiline_response)
-                    else:
-                        client_sock.sendall(b'ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock) 
-                case "DELE":
-                    if client["state"] == States.POP3_TRAN:
-                        msg_num = line[5:].decode()
-                        if msg_num.isnumeric() and len(user_emails) >= int(msg_num) >= 1:
-                            msg_num = int(msg_num.strip())
-                            client["to_delete"].append(msg_num-1)
-                            client_sock.sendall((f"+OK message {msg_num} deleted\r\n").encode())
-                    else:
-                        client_sock.sendall(b'ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "NOOP":
-                    if client["state"] == States.POP3_TRAN:
-                        client_sock.sendall(b"+OK\r\n")
-                    else:
-                        client_sock.sendall(b'ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "RSET":
-                    if client["state"] == States.POP3_TRAN:
-                        client["to_delete"] = []
-                    client_sock.sendall((f"+OK maildrop has {len(user_emails)} messages ({sum(len(email["msg"]) for email in user_emails)} octets)").encode())
-                case "QUIT":
-                    client_sock.sendall(f"+OK pop3-server{self.server_sock.getsockname()[1]} POP3 server signing off (maildrop empty)".encode())
-                    if client["to_delete"] != []:
-                        keep_emails = []
-                        for i in range(len(user_emails)):
-                            if i not in client["to_delete"]:
-                                keep_emails.append(user_emails[i])
-                        self.write_emails(client["username"], keep_emails)
-                    self.disconnect(client_sock)
-
-    def write_emails(self, username, newemails):
-        """Save a list of emails to the database json associated with this domain, replacing any previously stored emails.
-
-        :param username: the username to which the emails belong
-        :param newemails: the list of emails to save.
+        wire_log.debug("received from POP3 client %s: %r", client["addr"], input_lines)
+        for i, (command, args) in enumerate(parse_lines(input_lines, POP3_VERBS, "NOOP")):
+            if client["closing"]:
+                break
+            if client["waiting"]:
+                # a mailbox read is still running; the rest is handled once it has answered
+                client["buffer"] = b"".join(line + b"\r\n" for line in input_lines[i:]) + client["buffer"]
+                break
+            pop_log.debug("%s: %s", client["addr"], command)
+            with command_seconds.time("pop3", command):
+                self.dispatch(self.pop_handlers, self.pop_fallbacks, self.pop_unexpected, client_sock, command, args)
+        self.flush(client_sock) # one write for every reply to the batch
+
+    def dispatch(self, handlers, fallbacks, unexpected, client_sock, command, args):
+        """Call the handler of a command in the client's current state, answering a syntax error if the command cannot
+        be parsed.
+
+        :param handlers: the per-state handler tables of the protocol: state -> command -> handler.
+        :param fallbacks: the handlers of commands missing from a state's table, for the states that have one.
+        :param unexpected: the handler of commands a state does not accept.
+        :param client_sock: the client socket the command was received from
+        :param command: the name of the command
+        :param args: the command's arguments
+        :return: what the handler returns
         """
 
-        emails = {}
-        with open(f"{self.domain.split(".")[0]}/emails.json", 'r') as f:
-            emails = json.load(f)
-            emails[username] = newemails
-        with open(f"{self.domain.split(".")[0]}/emails.json", 'w') as f:
-            json.dump(emails, f, indent=4, ensure_ascii=False)
+        client = self.clients[client_sock]
+        handler = handlers.get(client["state"], {}).get(command) or fallbacks.get(client["state"], unexpected)
+        try:
+            return handler(client_sock, args)
+        except ValueError: # including UnicodeDecodeError; one malformed line must not end every session
+            log.warning("Malformed %s command from %s: %r", client["type"], client["addr"], args[:80])
+            self.send(client_sock, b"-ERR Syntax error\r\n" if client["type"] == "POP3" else b"500 Syntax error\r\n")
+
+    def fetch(self, client_sock, reply, fn, *args):
+        """Run a blocking mailbox read for a POP3 command, on the loop's thread pool under the asyncio engine, then
+        answer with its result.
+
+        :param client_sock: the client socket the command was received from
+        :param reply: called with the result of the read to send the reply
+        :param fn: the read to run
+        :param args: the arguments to pass to fn
+        """
 
-    def disconnect(self, client):
-        """Disconnect from a client
+        if self.loop is None:
+            self.answer_fetch(client_sock, reply, lambda: fn(*args))
+            return
+        self.clients[client_sock]["waiting"] = True
+        future = self.loop.run_in_executor(None, fn, *args)
+        future.add_done_callback(lambda done: self.answer_fetch(client_sock, reply, done.result))
 
-        :param client: the client from which to disconnect
+    def answer_fetch(self, client_sock, reply, result):
+        """Answer a POP3 command with the result of its mailbox read, then handle the commands held back meanwhile.
+
+        :param client_sock: the client socket the command was received from
+        :param reply: called with the result of the read to send the reply
+        :param result: returns the result of the read, or raises what the read raised
         """
 
-        del self.clients[client]
-        self.inputs.remove(client)
-        client.close()
+        client = self.clients.get(client_sock)
+        if client is None:
+            return
+        try:
+            reply(result())
+        except OSError:
+            pop_log.exception("Could not read %s's mailbox", client["username"])
+            self.send(client_sock, b"-ERR Mailbox unavailable\r\n")
+        if client["waiting"]:
+            client["waiting"] = False
+            self.pop_commands(client_sock)
 
-    def parse_commands(self, lines) -> list[str]:
-        """Parse client SMTP commands from a list of lines
+    def pop_unexpected(self, client_sock, args):
+        """Refuse a POP3 command the session's state does not accept, and disconnect."""
 
-        :param lines: the list of lines to parse.
-        """
+        self.send(client_sock, b'ERROR Unexpected Command\r\n')
+        self.disconnect(client_sock)
+
+    def pop_user(self, client_sock, args):
+        """USER: take the username of the account to log in to."""
+
+        client = self.clients[client_sock]
+        client["username"] = args.decode(errors="replace")
+        self.send(client_sock, (f'+OK {client["username"]}\r\n').encode())
+        client["state"] = States.AUTH_PW
+
+    def pop_pass(self, client_sock, args):
+        """PASS: check the password and load the maildrop, which stays loaded for the rest of the session."""
+
+        client = self.clients[client_sock]
+        client["pw"] = args.decode(errors="replace")
+        if self.verify_account(client):
+            def reply(entries):
+                maildrop = client["maildrop"] = Maildrop(entries)
+                self.send(client_sock, (f"+OK {client["username"]}'s maildrop has {maildrop.count} messages ({maildrop.octets} octets)\r\n").encode())
+                client["state"] = States.POP3_TRAN
+            self.fetch(client_sock, reply, self.load_emails, client)
+        else:
+            self.send(client_sock, b'ERROR Authentication credentials invalid\r\n')
+            client["state"] = States.AUTH_USER
 
-        commands = []
-        for line in lines:
-            line = line.decode()
-            print(f"line={line}")
-            if line.startswith("EHLO") or line.startswith("HELO"):
-                commands.append("EHLO")
-            elif line.startswith("AUTH LOGIN"):
-                commands.append("AUTH LOGIN")
-            elif line.startswith("MAIL FROM"):
-                commands.append("MAIL FROM")
-            elif line.startswith("RCPT TO"):
-                commands.append("RCPT TO")
-            elif line.startswith("DATA"):
-                commands.append("DATA")
-            elif line.startswith("QUIT"):
-                commands.append("QUIT")
+    def pop_stat(self, client_sock, args):
+        """STAT: the number and total size of the messages."""
+
+        maildrop = self.clients[client_sock]["maildrop"]
+        self.send(client_sock, (f'+OK {maildrop.count} {maildrop.octets}\r\n').encode())
+
+    def pop_list(self, client_sock, args):
+        """LIST [n]: the size of one message, or of every message."""
+
+        maildrop = self.clients[client_sock]["maildrop"]
+        parts = args.split()
+        if len(parts) == 1:
+            num = parts[0].decode(errors="replace")
+            if maildrop.get(num) is not None:
+                self.send(client_sock, (f"+OK {num} {maildrop.sizes[int(num) - 1]}\r\n").encode())
             else:
-                commands.append("TEXT")
-        return commands
-    
-    def parse_pop3_commands(self, lines) -> list[str]:
-        """Parse client SMTP commands from a list of lines
+                self.send(client_sock, b'ERROR No such message\r\n')
+        else:
+            final_str = f"+OK {maildrop.count} messages ({maildrop.octets} octets)\r\n"
+            final_str += "".join(f"{num} {size}\r\n" for num, size in maildrop.listing())
+            final_str += ".\r\n"
+            self.send(client_sock, final_str.encode())
 
-        :param lines: the list of lines to parse
-        """
+    def pop_retr(self, client_sock, args):
+        """RETR n: a whole message."""
+
+        client = self.clients[client_sock]
+        current_email = client["maildrop"].get(args.decode(errors="replace"))
+        if current_email is not None:
+            def reply(body):
+                multiline_response = f"+OK {current_email["len"]} octets\r\n".encode()
+                multiline_response += f"From: {current_email["from"]}\r\n".encode()
+                multiline_response += f"To: {client["username"]}@{client["hosted"].name}\r\n".encode()
+                self.send(client_sock, multiline_response + body)
+            self.fetch(client_sock, reply, client["hosted"].mailboxes.read, client["username"], current_email)
+        else:
+            self.send(client_sock, b'ERROR No such message\r\n')
+
+    def pop_top(self, client_sock, args):
+        """TOP n lines: the headers of a message and the first lines of its body."""
+
+        client = self.clients[client_sock]
+        parts = args.decode(errors="replace").split()
+        current_email = client["maildrop"].get(parts[0]) if len(parts) == 2 and parts[1].isdecimal() else None
+        if current_email is not None:
+            def reply(top):
+                multiline_response = b"+OK\r\n"
+                multiline_response += f"From: {current_email["from"]}\r\n".encode()
+                multiline_response += f"To: {client["username"]}@{client["hosted"].name}\r\n".encode()
+                self.send(client_sock, multiline_response + top + b".\r\n")
+            # served from the header index; only the requested body lines are read from the stored message
+            self.fetch(client_sock, reply, client["hosted"].mailboxes.top, client["username"], current_email, int(parts[1]))
+        else:
+            self.send(client_sock, b'ERROR No such message\r\n')
 
-        commands = []
-        for line in lines:
-            line = line.decode()
-            if line.startswith("USER"):
-                commands.append("USER")
-            elif line.startswith("PASS"):
-                commands.append("PASS")
-            elif line.startswith("QUIT"):
-                commands.append("QUIT")
-            elif line.startswith("STAT"):
-                commands.append("STAT")
-            elif line.startswith("LIST"):
-                commands.append("LIST")
-            elif line.startswith("RETR"):
-                commands.append("RETR")
-            elif line.startswith("DELE"):
-                commands.append("DELE")
-            elif line.startswith("LAST"):
-                commands.append("LAST")
-            elif line.startswith("RSET"):
-                commands.append("RSET")
+    def pop_uidl(self, client_sock, args):
+        """UIDL [n]: the unique id of one message, or of every message."""
+
+        maildrop = self.clients[client_sock]["maildrop"]
+        parts = args.split()
+        if len(parts) == 1:
+            num = parts[0].decode(errors="replace")
+            if maildrop.uid(num) is not None:
+                self.send(client_sock, (f"+OK {num} {maildrop.uid(num)}\r\n").encode())
             else:
-                commands.append("NOOP")
-        return commands
+                self.send(client_sock, b'ERROR No such message\r\n')
+        else:
+            final_str = "+OK\r\n"
+            final_str += "".join(f"{num} {maildrop.uid(num)}\r\n" for num, _ in maildrop.listing())
+            final_str += ".\r\n"
+            self.send(client_sock, final_str.encode())
+
+    def pop_dele(self, client_sock, args):
+        """DELE n: mark a message for deletion when the session ends."""
+
+        msg_num = args.decode(errors="replace").strip()
+        if self.clients[client_sock]["maildrop"].delete(msg_num):
+            self.send(client_sock, (f"+OK message {msg_num} deleted\r\n").encode())
+        else:
+            self.send(client_sock, b'ERROR No such message\r\n')
+
+    def pop_noop(self, client_sock, args):
+        """NOOP, and any command not recognized once logged in."""
+
+        self.send(client_sock, b"+OK\r\n")
+
+    def pop_rset(self, client_sock, args):
+        """RSET: unmark every message marked for deletion."""
+
+        maildrop = self.clients[client_sock]["maildrop"]
+        maildrop.reset()
+        self.send(client_sock, (f"+OK maildrop has {maildrop.count} messages ({maildrop.octets} octets)\r\n").encode())
+
+    def pop_quit(self, client_sock, args):
+        """QUIT: delete the messages marked for deletion and end the session."""
+
+        client = self.clients[client_sock]
+        self.send(client_sock, f"+OK pop3-server{self.server_sock.getsockname()[1]} POP3 server signing off (maildrop empty)\r\n".encode())
+        if client["maildrop"] is not None:
+            client["hosted"].mailboxes.delete(client["username"], client["maildrop"].deleted_entries())
+        self.disconnect(client_sock)
+
+    def send(self, client_sock, data):
+        """Queue a reply for a client. Replies are written out by flush.
+
+        :param client_sock: the client to reply to
+        :param data: the bytes to send
+        """
+
+        client = self.clients.get(client_sock)
+        if client is not None and not client["closing"]:
+            client["out"] += data
+            sent_bytes.inc(client["type"].lower(), amount=len(data))
+
+    def flush(self, client_sock):
+        """Write as much of a client's queued replies as its socket will take without blocking. Whatever is left is
+        written once select reports the socket writable again.
+
+        :param client_sock: the client whose replies to write
+        """
+
+        client = self.clients.get(client_sock)
+        if client is None:
+            return
+        out = client["out"]
+        try:
+            while out:
+                sent = client_sock.send(out)
+                if sent == 0:
+                    break
+                del out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            out.clear()
+            client["closing"] = True
+        if out:
+            self.outputs.add(client_sock)
+            return
+        self.outputs.discard(client_sock)
+        if client["closing"]:
+            self.clients.pop(client_sock, None)
+            self.inputs.discard(client_sock) # a closed socket left here would make select fail for every client
+            self.drop_message(client)
+            client_sock.close()
+
+    def drop_message(self, client):
+        """Discard the message a client was in the middle of sending when its session ended.
+
+        :param client: the entry from self.clients of the client.
+        """
+
+        if client["state"] == States.BODY:
+            client["msg"].close()
+
+    def connection_states(self):
+        """Count the open client connections by protocol and state, for the mail_connections gauge.
+
+        :return: a dict of (protocol, state) to the number of connections.
+        """
+
+        counts = {}
+        for client in list(self.clients.values()):
+            key = (client["type"].lower(), client["state"].name)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def disconnect(self, client):
+        """Disconnect from a client once the replies queued for it have been written
+
+        :param client: the client from which to disconnect
+        """
+
+        self.inputs.discard(client)
+        if client in self.clients:
+            self.clients[client]["closing"] = True
+            self.flush(client)
+        else:
+            client.close()
 
     def verify_account(self, client):
-        """Verify that the client has provided correct credentials.
+        """Verify that the client has provided correct credentials, as user@domain or a bare user of the server's domain.
 
         :param client: the entry from self.clients of the client to check.
         """
 
-        return self.accounts[client["username"]] == client["pw"]
+        username, _, name = client["username"].partition("@")
+        hosted = self.hosted.get(name.lower() or self.domain)
+        if hosted is None or hosted.accounts.get(username) != client["pw"]: # unknown users fail like a wrong password
+            return False
+        client["hosted"] = hosted
+        client["username"] = username
+        return True
 
-    def update_emails(self, client):
-        """Update the emails.json with a newly received email
+    def update_emails(self, client, hosted, usernames):
+        """Append a newly received email to the mailboxes of its recipients in one hosted domain, storing its body once
+        however many of them there are
 
         :param client: the entry from self.clients of the client to use.
+        :param hosted: the HostedDomain of the recipients.
+        :param usernames: the usernames of the recipients.
         """
 
-        emails = {}
-        with open(f"{self.domain.split(".")[0]}/emails.json", 'r') as f:
-            emails = json.load(f)
-        with open(f"{self.domain.split(".")[0]}/emails.json", 'w') as f:
-            if client["dst"].split(b"@")[0].decode() not in emails:
-                emails[client["dst"].split(b"@")[0].decode()] = []
-            emails[client["dst"].split(b"@")[0].decode()].append({"FROM": client["from"], "msg": client['msg']})
-            json.dump(emails, f, indent=4, ensure_ascii=False)
+        hosted.mailboxes.deliver_many(usernames, client["from"], client['msg'])
 
-    def forward_email(self, client_sock):
-        """Check if a received email is addressed to this domain, saving it if it is and forwarding to another SMTP
-        server if not.
+    def accept_message(self, client_sock, client):
+        """Hand a received message on, answering 250 once it is stored or spooled and 451 if it could not be.
 
-        :param client_sock: the client socket from which the email was received
+        :param client_sock: the client socket the message was received from
+        :param client: a copy of the client's entry in self.clients, see forward_email
         """
 
-        client = self.clients[client_sock]
-        to_domain = client["dst"].split(b"@")[-1].decode()
-        print(f"To domain = {to_domain}")
-        if to_domain == self.domain:
-            print("Updating Emails")
-            self.update_emails(client)
-        else:
-            # do DNS lookup for dst
-            dst_addr = dns.dns.dns_lookup(self.dns_ip, self.dns_port, to_domain)
-            if dst_addr:
-                dst_addr = dst_addr.split(" ")
-                dst_addr = (dst_addr[0], int(dst_addr[1]))
-                # make Client instance
-                sender = smtp_client.EmailClient()
-                # use that to send to the other server
-                sender.send_email(self_username="server", username=client["from"].split("@")[0], pw=SERVER_PASSWORD, to_addr=client["dst"].decode(), msg = client["msg"], dst_addr = dst_addr, forward=True, domain=self.domain)
+        if self.loop is None:
+            self.answer_message(client_sock, self.try_forward(client))
+            return
+        self.clients[client_sock]["waiting"] = True
+        future = self.loop.run_in_executor(None, self.try_forward, client)
+        future.add_done_callback(lambda done: self.answer_message(client_sock, done.result()))
+
+    def try_forward(self, client):
+        """Hand a received message on, see forward_email.
+
+        :param client: a copy of the entry from self.clients of the client the message was received from.
+        :return: True if the message was stored or spooled for every recipient, False if it failed.
+        """
+
+        try:
+            self.forward_email(client)
+            return True
+        except Exception:
+            smtp_log.exception("Could not store the message from %s", client["from"])
+            messages.inc("failed")
+            return False
+
+    def answer_message(self, client_sock, stored):
+        """Answer the end of a message, then handle any commands the client sent while it was being stored.
+
+        :param client_sock: the client socket the message was received from
+        :param stored: whether the message was stored or spooled
+        """
+
+        client = self.clients.get(client_sock)
+        if client is None:
+            return
+        client["waiting"] = False
+        self.send(client_sock, b"250 Ok: queued\r\n" if stored else b"451 Requested action aborted: local error in processing\r\n")
+        if self.loop is not None:
+            self.smtp_commands(client_sock)
+
+    def forward_email(self, client):
+        """Deliver a received email to its hosted recipients and spool it once per other domain for relaying.
+
+        :param client: a copy of the entry from self.clients of the client from which the email was received.
+        """
+
+        smtp_log.debug("message from %s for %s", client["from"], client["dst"])
+        by_domain = {} # domain -> recipients in it, in the order they were given
+        for rcpt in client["dst"]:
+            by_domain.setdefault(rcpt.rpartition("@")[2].lower(), []).append(rcpt)
+        try:
+            for to_domain, rcpts in by_domain.items():
+                if to_domain in self.hosted:
+                    # copied from the spooled file straight into the mailbox storage
+                    self.update_emails(client, self.hosted[to_domain], [rcpt.rpartition("@")[0] for rcpt in rcpts])
+                    messages.inc("delivered", amount=len(rcpts))
+                else:
+                    # spooled for the sending domain's relay threads, which retry until the destination accepts
+                    client["hosted"].relay.enqueue(client["from"], rcpts, client["msg"])
+                    messages.inc("relayed", amount=len(rcpts))
+        finally:
+            client["msg"].close()
 
     def smtp_commands(self, client_sock):
         """Process smtp commands from the client, responding as appropriate.
@@ -352,76 +653,185 @@ class Server:
         """
 
         client = self.clients[client_sock]
-        input_lines = client['buffer'].split(b"\r\n")
-        client['buffer'] = input_lines[-1] # write unfinished line back to the dict
-        input_lines = input_lines[:-1]
-        print(f"received form client, input={input_lines}")
-        commands = self.parse_commands(input_lines)
-        for i, command in enumerate(commands):
-            print(f"received command {command}")
-            line = input_lines[i]
-            match command:
-                case "EHLO" | "HELO":
-                    if client["state"] == States.INIT:
-                        client['state'] = States.AUTH_INIT
-                        client_sock.sendall(f"250-smtp-server{self.server_sock.getsockname()[1]}.{self.domain}\r\n250-AUTH LOGIN PLAIN\r\n250 Ok\r\n".encode())
-                    else:
-                        client_sock.sendall(b'ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "AUTH LOGIN":
-                    if client["state"] == States.AUTH_INIT:
-                        client_sock.sendall(b"334 " + base64.b64encode(b"Username:"))
-                        client["state"] = States.AUTH_USER
-                    else:
-                        client_sock.sendall(b'-ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "TEXT":
-                    if client["state"] == States.AUTH_USER:
-                        client["username"] = base64.b64decode(line.decode()).decode()
-                        client_sock.sendall(b"334 " + base64.b64encode(b"Password:"))
-                        client["state"] = States.AUTH_PW
-                    elif client["state"] == States.AUTH_PW:
-                        client["pw"] = base64.b64decode(line.decode()).decode()
-                        if self.verify_account(client):
-                            client_sock.sendall(b"235 2.7.0 Authentication successful")
-                            client["state"] = States.READY
-                        else:
-                            client_sock.sendall(b"535 5.7.8 Authentication credentials invalid")
-                            self.disconnect(client_sock)
-                    elif client["state"] == States.DATA:
-                        client["msg"] += line + b"\r\n"
-                        print(f"Added line to message: {line}")
-                        if line == b".":
-                            client_sock.sendall(b"250 Ok: queued")
-                            client["msg"] = client["msg"].decode()
-                            self.forward_email(client_sock)
-                    else:
-                        client_sock.sendall(b'-ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "MAIL FROM":
-                    if client["state"] == States.READY:
-                        client["from"] = line.decode()[10:]
-                        client["state"] = States.DEST
-                        client_sock.sendall(b"250 Ok\r\n")
-                    else:
-                        client_sock.sendall(b'-ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "RCPT TO":
-                    if client["state"] == States.DEST:
-                        client["dst"] = line[8:]
-                        client["state"] = States.DATA
-                        client_sock.sendall(b"250 Ok\r\n")
-                    else:
-                        client_sock.sendall(b'-ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "DATA":
-                    if client["state"] == States.DATA:
-                        client_sock.sendall(b"354 End data with <CR><LF>.<CR><LF>")
-                    else:
-                        client_sock.sendall(b'-ERROR Unexpected Command\r\n')
-                        self.disconnect(client_sock)
-                case "QUIT":
-                    self.disconnect(client_sock)
+        while not client["closing"] and not client["waiting"]:
+            if client["state"] == States.BODY:
+                self.receive_body(client_sock)
+                if client["state"] == States.BODY or client["waiting"]:
+                    break # the rest of the message has not arrived yet, or it is still being stored
+            input_lines = client['buffer'].split(b"\r\n")
+            client['buffer'] = input_lines[-1] # write unfinished line back to the dict
+            input_lines = input_lines[:-1]
+            if not input_lines or not self.run_smtp_lines(client_sock, input_lines):
+                break
+        self.flush(client_sock) # one write for every reply to the batch
+
+    def run_smtp_lines(self, client_sock, input_lines):
+        """Handle a batch of complete SMTP command lines. Handling stops after a DATA command is accepted, since the
+        lines after it are message content; they are put back into the client's buffer for receive_body.
+
+        :param client_sock: the client socket the lines were received from
+        :param input_lines: the received lines, without their line endings
+        :return: True if handling stopped at the start of a message, False if every line was handled
+        """
+
+        client = self.clients[client_sock]
+        wire_log.debug("received from SMTP client %s: %r", client["addr"], input_lines)
+        for i, (command, args) in enumerate(parse_lines(input_lines, SMTP_VERBS, "TEXT")):
+            if client["closing"]:
+                break
+            smtp_log.debug("%s: %s", client["addr"], command)
+            with command_seconds.time("smtp", command):
+                started_body = self.dispatch(self.smtp_handlers, self.smtp_fallbacks, self.smtp_unexpected, client_sock, command, args)
+            if started_body:
+                client["buffer"] = b"".join(rest + b"\r\n" for rest in input_lines[i + 1:]) + client["buffer"]
+                return True
+        return False
+
+    def smtp_unexpected(self, client_sock, args):
+        """Refuse an SMTP command the session's state does not accept, and disconnect."""
+
+        self.send(client_sock, b'-ERROR Unexpected Command\r\n')
+        self.disconnect(client_sock)
+
+    def smtp_ehlo(self, client_sock, args):
+        """EHLO or HELO: advertise the server's extensions."""
+
+        self.clients[client_sock]['state'] = States.AUTH_INIT
+        self.send(client_sock, f"250-smtp-server{self.server_sock.getsockname()[1]}.{self.domain}\r\n250-AUTH LOGIN PLAIN\r\n250-PIPELINING\r\n250-SIZE {self.max_message_bytes}\r\n250 Ok\r\n".encode())
+
+    def smtp_auth(self, client_sock, args):
+        """AUTH LOGIN: ask for the username."""
+
+        if args[:5].upper() != b"LOGIN":
+            return self.smtp_unexpected(client_sock, args)
+        self.send(client_sock, b"334 " + base64.b64encode(b"Username:") + b"\r\n")
+        self.clients[client_sock]["state"] = States.AUTH_USER
+
+    def smtp_username(self, client_sock, line):
+        """The base64 username line of AUTH LOGIN: ask for the password."""
+
+        client = self.clients[client_sock]
+        try:
+            client["username"] = base64.b64decode(line).decode()
+        except ValueError:
+            return self.smtp_refuse_credentials(client_sock)
+        self.send(client_sock, b"334 " + base64.b64encode(b"Password:") + b"\r\n")
+        client["state"] = States.AUTH_PW
+
+    def smtp_password(self, client_sock, line):
+        """The base64 password line of AUTH LOGIN: check the credentials."""
+
+        client = self.clients[client_sock]
+        try:
+            client["pw"] = base64.b64decode(line).decode()
+        except ValueError:
+            return self.smtp_refuse_credentials(client_sock)
+        if self.verify_account(client):
+            self.send(client_sock, b"235 2.7.0 Authentication successful\r\n")
+            client["state"] = States.READY
+        else:
+            self.smtp_refuse_credentials(client_sock)
+
+    def smtp_refuse_credentials(self, client_sock):
+        """Refuse the credentials of AUTH LOGIN and disconnect."""
+
+        self.send(client_sock, b"535 5.7.8 Authentication credentials invalid\r\n")
+        self.disconnect(client_sock)
+
+    def smtp_mail(self, client_sock, args):
+        """MAIL FROM: start a transaction, refusing it up front if the declared SIZE is over the limit."""
+
+        if args[:5].upper() != b"FROM:":
+            return self.smtp_unexpected(client_sock, args)
+        client = self.clients[client_sock]
+        sender, *params = args[5:].decode(errors="replace").split(" ")
+        size = [p[5:] for p in params if p.upper().startswith("SIZE=")]
+        if size and size[0].isdecimal() and int(size[0]) > self.max_message_bytes:
+            # refuse a declared oversized message before any of it is sent
+            self.send(client_sock, b"552 Message size exceeds fixed maximum message size\r\n")
+            return
+        client["from"] = sender
+        client["state"] = States.DEST
+        self.send(client_sock, b"250 Ok\r\n")
+
+    def smtp_rcpt(self, client_sock, args):
+        """RCPT TO: add a recipient. It may be given several times in a transaction, up to MAX_RECIPIENTS."""
+
+        if args[:3].upper() != b"TO:":
+            return self.smtp_unexpected(client_sock, args)
+        client = self.clients[client_sock]
+        rcpt = args[3:].decode(errors="replace").strip().strip("<>")
+        if "@" not in rcpt:
+            self.send(client_sock, b"501 Syntax error in recipient address\r\n")
+            return
+        if len(client["dst"]) >= MAX_RECIPIENTS:
+            self.send(client_sock, b"452 Too many recipients\r\n")
+            return
+        client["dst"].append(rcpt)
+        client["state"] = States.DATA
+        self.send(client_sock, b"250 Ok\r\n")
+
+    def smtp_data(self, client_sock, args):
+        """DATA: start receiving the message.
+
+        :return: True, as the lines after this one are message content
+        """
+
+        client = self.clients[client_sock]
+        self.send(client_sock, b"354 End data with <CR><LF>.<CR><LF>\r\n")
+        client["state"] = States.BODY
+        client["msg"] = tempfile.SpooledTemporaryFile(self.spill_bytes)
+        client["size"] = 0
+        client["tail"] = b"\r\n" # so that a message of only "." is recognized as ended
+        return True
+
+    def smtp_rset(self, client_sock, args):
+        """RSET: abandon the transaction in progress."""
+
+        self.reset_transaction(self.clients[client_sock])
+        self.send(client_sock, b"250 Ok\r\n")
+
+    def smtp_quit(self, client_sock, args):
+        """QUIT: end the session."""
+
+        self.disconnect(client_sock)
+
+    def receive_body(self, client_sock):
+        """Move received message content from the client's buffer into the message being received, up to the "." line.
+
+        :param client_sock: the client socket in the BODY state
+        """
+
+        client = self.clients[client_sock]
+        data = client["buffer"]
+        scan = client["tail"] + data
+        end = scan.find(b"\r\n.\r\n")
+        cut = len(data) if end == -1 else end + 5 - len(client["tail"])
+        client["size"] += cut
+        if client["size"] <= self.max_message_bytes:
+            client["msg"].write(data[:cut])
+        client["tail"] = scan[-4:]
+        client["buffer"] = data[cut:]
+        if end == -1:
+            return
+        if client["size"] > self.max_message_bytes:
+            client["msg"].close()
+            messages.inc("too_large")
+            self.send(client_sock, b"552 Message size exceeds fixed maximum message size\r\n")
+        else:
+            self.accept_message(client_sock, dict(client))
+        self.reset_transaction(client) # the session can carry another message
+
+    def reset_transaction(self, client):
+        """Clear the mail transaction of an authenticated SMTP session, so that it can start another with MAIL FROM.
+
+        :param client: the entry from self.clients of the client to reset.
+        """
+
+        client["from"] = b""
+        client["dst"] = []
+        client["msg"] = b""
+        client["state"] = States.READY
 
     def run(self):
         """Run the server.
@@ -429,20 +839,121 @@ class Server:
 
         try:
             while(True):
-                readable_socks, _, _ = select.select(self.inputs, [], [])
+                readable_socks, writable_socks, _ = select.select(self.inputs, self.outputs, [])
+                for sock in writable_socks:
+                    self.flush(sock)
                 for sock in readable_socks:
-                    if sock in [self.server_sock, self.pop_sock]:
+                    if sock in self.listeners:
                         self.new_client(sock)
-                    else:
+                    elif sock in self.clients:
                         self.read_from_client(sock)
         except Exception as e:
             self.server_sock.close()
             self.pop_sock.close()
             raise e
+        finally:
+            self.flush_mailboxes() # don't lose deletions still queued for the disk
+
+    def withdraw(self):
+        """Stop renewing this server's DNS registrations and withdraw them, so that clients fail over to each domain's
+        other servers straight away.
+        """
+
+        for heartbeat, name in zip(self.heartbeats, self.hosted):
+            heartbeat.set()
+            dns.dns.dns_update(self.dns_ip, self.dns_port, name, self.server_sock.getsockname()[1], 0)
+        self.heartbeats = []
 
-def main(dns, domain):
-    server = Server(dns_ip=dns, domain=domain)
-    server.run()
+def run_server(server, engine):
+    """Run a server on the chosen engine.
+
+    :param server: the Server to run.
+    :param engine: the name of the engine, "select" or "asyncio".
+    """
+    try:
+        if engine == "asyncio":
+            aio_engine.run(server)
+        else:
+            server.run()
+    finally:
+        server.withdraw()
+
+def supervise(dns_ip, domain, engine, workers, max_message_bytes = MAX_MESSAGE_BYTES, stats_port = None, domains = (), pop_port = POP3_PORT):
+    """Run a server as several worker processes sharing the same SMTP and POP3 ports, restarting any that die.
+
+    :param dns_ip: the IP of the DNS server.
+    :param domain: the email domain for which the workers should operate.
+    :param engine: the name of the engine each worker should run.
+    :param workers: the number of worker processes.
+    :param max_message_bytes: the largest message the workers accept, in bytes.
+    :param stats_port: if set, each worker serves its metrics on its own port counting up from this one.
+    :param domains: further domains the workers host alongside domain.
+    :param pop_port: the port to accept POP3 connections on.
+    """
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    port = random.randint(5000, 8000)
+    listeners = open_listeners(port, pop_port, reuse_port=reuse_port, listen=not reuse_port)
+    log.info("Server socket bound to port %d", port)
+    names = list(dict.fromkeys([domain, *domains]))
+    for name in names:
+        MailStore(name.split(".")[0]).migrate_json(f"{name.split(".")[0]}/emails.json") # before any worker starts
+    heartbeats = [dns.dns.dns_heartbeat(dns_ip, 8080, name, port) for name in names]
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            # stop on SIGTERM the same way as on Ctrl-C, so queued mailbox writes are flushed before exiting
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            status = 0
+            try:
+                own = open_listeners(port, pop_port, reuse_port=True) if reuse_port else listeners
+                if stats_port is not None:
+                    metrics.serve(stats_port + slot)
+                run_server(Server(dns_ip=dns_ip, domain=domain, listeners=own, max_message_bytes=max_message_bytes, domains=domains), engine)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                log.exception("Worker failed")
+                status = 1
+            finally:
+                os._exit(status)
+        return pid
+
+    children = {spawn(slot): (time.monotonic(), slot) for slot in range(workers)} # pid -> (start time, worker slot)
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if stopping or child is None:
+            continue
+        started, slot = child
+        log.warning("Worker %d exited, restarting", pid)
+        if time.monotonic() - started < 1:
+            time.sleep(1) # don't spin if a worker dies immediately on every start
+        children[spawn(slot)] = (time.monotonic(), slot)
+    for heartbeat, name in zip(heartbeats, names):
+        heartbeat.set()
+        dns.dns.dns_update(dns_ip, 8080, name, port, 0)
+
+def main(dns, domain, engine = "select", workers = 1, max_message_bytes = MAX_MESSAGE_BYTES, stats_port = None, domains = (), pop_port = POP3_PORT):
+    if workers > 1:
+        supervise(dns, domain, engine, workers, max_message_bytes, stats_port, domains, pop_port)
+    else:
+        if stats_port is not None:
+            metrics.serve(stats_port)
+        run_server(Server(dns_ip=dns, domain=domain, max_message_bytes=max_message_bytes, domains=domains, pop_port=pop_port), engine)
 
 if __name__ == "__main__":
     # Create the parser
@@ -451,7 +962,16 @@ if __name__ == "__main__":
     # Add arguments
     parser.add_argument('-dns',  required=False,type=str, default="127.0.0.1", help='The destination IP for the DNS server. Should be set to the LAN IP of the machine on which the DNS is running if communicating between machines. Defaults to localhost.')
     parser.add_argument('-domain',  required=False,type=str, default="abeersclass.com", help='Domain for which this server should operate. Defaults to "abeersclass.com"')
+    parser.add_argument('-domains', '--domains', required=False, type=lambda text: [name for name in text.split(",") if name], default=[], help='Further domains to host in the same process, comma separated, e.g. "email.com,example.org". Each needs its own data directory, as for -domain. Their users log in as user@domain, and mail between hosted domains is delivered without relaying.')
+    parser.add_argument('-pop-port', '--pop-port', required=False, type=int, default=POP3_PORT, help=f'Port to accept POP3 connections on, for every hosted domain. Defaults to {POP3_PORT}.')
+    parser.add_argument('-engine', '--engine', required=False, choices=["select", "asyncio"], default="select", help='Event loop to serve clients with. "asyncio" scales to many more concurrent connections than "select", which is kept for comparison. Defaults to "select".')
+    parser.add_argument('-workers', '--workers', required=False, type=int, default=1, help='Number of worker processes sharing the SMTP and POP3 ports, restarted by a supervisor if they die. Defaults to 1, which runs the server in this process.')
+    parser.add_argument('-max-size', '--max-message-size', required=False, type=int, default=MAX_MESSAGE_BYTES, help=f'Largest message accepted, in bytes. Larger messages are refused with 552 and are never held in memory. Defaults to {MAX_MESSAGE_BYTES}.')
+    
+    logconfig.add_arguments(parser)
+    parser.add_argument('-stats-port', '--stats-port', required=False, type=int, default=None, help='Serve metrics in the Prometheus text format over HTTP on this port, on localhost only. With several workers, each serves its own on the ports counting up from this one. Off by default.')
     
     args = parser.parse_args()
-    main(args.dns, args.domain)
+    logconfig.setup_from(args)
+    main(args.dns, args.domain, args.engine, args.workers, args.max_message_size, args.stats_port, args.domains, args.pop_port)
 
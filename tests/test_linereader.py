@@ -0,0 +1,44 @@
+import pytest
+
+from linereader import LineReader, unstuff
+
+class Chunks:
+    """A socket stand-in that returns the given chunks, one per receive."""
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        assert len(chunk) <= len(view)
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+def test_lines_split_across_receives():
+    reader = LineReader(Chunks(b"+OK he", b"llo\r", b"\n+OK two\r\n+OK"), chunk=8)
+    assert reader.read_line() == b"+OK hello"
+    assert reader.read_line() == b"+OK two"
+    assert reader.buffered() == 3 # the start of the next, pipelined, response stays buffered
+
+def test_multiline_smtp_reply():
+    reader = LineReader(Chunks(b"250-first\r\n250-second\r\n250 last\r\n220 next\r\n"))
+    assert reader.read_reply() == b"250-first\r\n250-second\r\n250 last\r\n"
+    assert reader.read_reply() == b"220 next\r\n"
+
+def test_blocks_are_unstuffed():
+    reader = LineReader(Chunks(b"..dot\r\nline\r", b"\n...two\r\n.\r", b"\n.\r\n"), chunk=16)
+    assert reader.read_block() == b".dot\r\nline\r\n..two\r\n"
+    assert reader.read_block() == b"" # an empty block is only its terminator
+    assert unstuff(b"a\r\n..b") == b"a\r\n.b"
+
+def test_large_block_in_small_chunks():
+    body = b"".join(b"line %d\r\n" % i for i in range(5000))
+    data = body + b".\r\n"
+    reader = LineReader(Chunks(*(data[i:i + 1000] for i in range(0, len(data), 1000))), chunk=1000)
+    assert reader.read_block() == body
+
+def test_closed_connection():
+    reader = LineReader(Chunks(b"+OK partial"))
+    with pytest.raises(ConnectionError):
+        reader.read_line()
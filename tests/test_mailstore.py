@@ -0,0 +1,76 @@
+import io
+import os
+import time
+
+from mailstore import ABANDONED_AGE, BodyStore, Maildrop, MailStore
+
+def age(path):
+    old = time.time() - ABANDONED_AGE - 60
+    os.utime(path, (old, old))
+
+def test_identical_bodies_are_stored_once(tmp_path):
+    bodies = BodyStore(str(tmp_path))
+    blob, length = bodies.put(io.BytesIO(b"Subject: hi\r\n\r\nbody\r\n"), ["a"])
+    again, _ = bodies.put(io.BytesIO(b"Subject: hi\r\n\r\nbody\r\n"), ["b", "c"])
+    assert again == blob and length == 21
+    assert [name for name in os.listdir(bodies.root) if not name.endswith(".refs")] == [blob]
+    with bodies.locked(blob) as f:
+        assert bodies.read_refs(f)[0] == {"a", "b", "c"}
+
+def test_body_is_removed_with_its_last_reference(tmp_path):
+    bodies = BodyStore(str(tmp_path))
+    blob, _ = bodies.put(io.BytesIO(b"shared"), ["a", "b"])
+    assert not bodies.release(blob, ["a"])
+    assert not bodies.release(blob, ["a"]) # releasing twice must not free the body b still uses
+    assert os.path.exists(bodies.path(blob))
+    assert bodies.release(blob, ["b"])
+    assert os.listdir(bodies.root) == []
+
+def test_refs_log_is_compacted(tmp_path):
+    bodies = BodyStore(str(tmp_path))
+    blob, _ = bodies.put(io.BytesIO(b"body"), ["keep"])
+    for i in range(100):
+        bodies.put(io.BytesIO(b"body"), [str(i)])
+        bodies.release(blob, [str(i)])
+    with open(bodies.path(blob, "refs")) as f:
+        assert len(f.read().splitlines()) < 50
+    with bodies.locked(blob) as f:
+        assert bodies.read_refs(f)[0] == {"keep"}
+
+def test_collect_drops_dead_and_abandoned_references(tmp_path):
+    bodies = BodyStore(str(tmp_path))
+    blob, _ = bodies.put(io.BytesIO(b"body"), ["live", "unindexed"])
+    orphan, _ = bodies.put(io.BytesIO(b"orphan"), ["dead"])
+    open(bodies.path("leftover", "tmp"), "w").close()
+    age(bodies.path("leftover", "tmp"))
+    assert bodies.collect({"dead"}, {"live"}) == 1
+    assert not os.path.exists(bodies.path(orphan))
+    assert not os.path.exists(bodies.path("leftover", "tmp"))
+    with bodies.locked(blob) as f:
+        assert bodies.read_refs(f)[0] == {"live", "unindexed"} # may still be on its way into an index
+    age(bodies.path(blob, "refs"))
+    bodies.collect(set(), {"live"})
+    with bodies.locked(blob) as f:
+        assert bodies.read_refs(f)[0] == {"live"}
+
+def test_mailstore_delete_and_collect(tmp_path):
+    store = MailStore(str(tmp_path))
+    entries = store.append_many(["a", "b"], "x@y.com", "Subject: s\r\n\r\nhello\r\n")
+    assert store.read("a", entries["a"]) == store.read("b", entries["b"]) == b"Subject: s\r\n\r\nhello\r\n"
+    store.delete("a", [entries["a"]])
+    assert os.path.exists(store.bodies.path(entries["b"]["blob"]))
+    assert store.collect() == 0
+    store.delete("b", [entries["b"]])
+    assert not os.path.exists(store.bodies.path(entries["b"]["blob"]))
+
+def test_maildrop_numbers_and_totals():
+    drop = Maildrop([{"uid": "u1", "len": 10}, {"uid": "u2", "len": 20}])
+    assert (drop.count, drop.octets) == (2, 30)
+    for bad in ("0", "3", "-1", "1.0", "²", "", "x"):
+        assert drop.get(bad) is None
+    assert drop.get(" 2 ")["uid"] == "u2"
+    assert drop.delete(1) and not drop.delete(1)
+    assert (drop.count, drop.octets, drop.listing()) == (1, 20, [(2, 20)])
+    assert drop.uid(1) is None and drop.deleted_entries() == [{"uid": "u1", "len": 10}]
+    drop.reset()
+    assert (drop.count, drop.octets) == (2, 30)
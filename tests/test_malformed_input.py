@@ -0,0 +1,73 @@
+import base64
+import json
+
+import pytest
+
+import smtp_server
+from dns.dns import DNS
+
+PASSWORD = "5e884898da28047151d0e56f8dc6292773603d0d6aabbdd62a11ef721d1542d8"
+
+class Connection:
+    """A client connection stand-in that records what the server sends."""
+    def __init__(self):
+        self.out = b""
+        self.closed = False
+
+    def send(self, data):
+        self.out += bytes(data)
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "abeersclass").mkdir()
+    (tmp_path / "abeersclass" / "accounts.json").write_text(json.dumps({"landon": PASSWORD}))
+    server = smtp_server.Server(listeners=smtp_server.open_listeners(0, 0))
+    yield server
+    server.server_sock.close()
+    server.pop_sock.close()
+
+def converse(server, pop, data):
+    conn = Connection()
+    server.add_client(conn, ("127.0.0.1", 0), pop)
+    server.clients[conn]["buffer"] += data
+    server.pop_commands(conn) if pop else server.smtp_commands(conn)
+    return conn, conn.out.decode().splitlines()
+
+def test_malformed_pop3_commands(server):
+    server.mailboxes.deliver("landon", "a@b.com", "Subject: s\r\n\r\nbody\r\n.\r\n")
+    conn, replies = converse(server, True, b"USER \xff\xfe\r\nPASS x\r\n")
+    assert replies[2] == "ERROR Authentication credentials invalid"
+    bad = ["RETR ²", "RETR 1.0", "TOP 1 -1", "TOP 1", "TOP ² 1", "LIST x", "UIDL \xff", "DELE 9"]
+    conn, replies = converse(server, True, "\r\n".join(["USER landon", "PASS " + PASSWORD, *bad, "STAT", ""]).encode())
+    assert replies[3:-1] == ["ERROR No such message"] * len(bad)
+    assert replies[-1] == "+OK 1 23"
+    assert conn in server.clients
+
+def test_malformed_smtp_commands(server):
+    login = b"EHLO x\r\nAUTH LOGIN\r\n" + base64.b64encode(b"landon") + b"\r\n" + base64.b64encode(PASSWORD.encode()) + b"\r\n"
+    conn, replies = converse(server, False, login + b"MAIL FROM:\xff@x SIZE=\xc2\xb2\r\nRCPT TO:nobody\r\nRSET\r\n\x00\x01\r\n")
+    assert replies[-4:] == ["250 Ok", "501 Syntax error in recipient address", "250 Ok", "-ERROR Unexpected Command"]
+    assert conn.closed and conn not in server.clients
+    conn, replies = converse(server, False, b"EHLO x\r\nAUTH LOGIN\r\n!!notbase64\r\n")
+    assert replies[-1] == "535 5.7.8 Authentication credentials invalid"
+
+def test_malformed_dns_updates(tmp_path):
+    dns = DNS(port=0, table_path=str(tmp_path / "table.json"))
+    try:
+        for request in ("UPDATE a.com 1.2.3.4 x", "UPDATE a.com 1.2.3.4 70000", "UPDATE a.com 1.2.3.4 25 nan",
+                        "UPDATE a.com 1.2.3.4 25 30 0", "UPDATE a.com 1.2.3.4 25 30 1000"):
+            assert dns.handle(request, False).startswith("ERROR")
+        assert dns.handle("UPDATE a.com 1.2.3.4 25", True) is None # updates are refused over UDP
+        assert dns.handle("", False) is None
+        assert dns.resolve("a.com").startswith("ERROR")
+        dns.handle("UPDATE a.com 1.2.3.4 25", False)
+        assert dns.handle("REQ a.com", False) == f"1.2.3.4 25 {dns.ttl}"
+    finally:
+        for sock in (dns.socket, dns.udp_socket, dns.waker, dns.wake_sock):
+            sock.close()
+        dns.selector.close()